@@ -20,8 +20,10 @@ resp = requests.post(f"{SERVICE_URL}?time_limit_sec=120",
      json=json.load(open(INPUT_JSON, encoding="utf-8")),
      timeout=3600)
 
-resp.raise_for_status()
+# 422 (INFEASIBLE) と 504 (UNKNOWN) も結果本体 (実行不可能の内容など) を返すので、エラーにせず保存する
+if resp.status_code not in (422, 504):
+    resp.raise_for_status()
 json.dump(resp.json(), open(OUTPUT_JSON, "w", encoding="utf-8"),
             ensure_ascii=False, indent=2)
 
-print(resp.json()["schedule_result"]["status"])
+print(resp.status_code, resp.headers.get("X-Solver-Status"), resp.json()["schedule_result"]["status"])
@@ -49,9 +49,8 @@ def _create_highs_solver(model_name="model"):
     try:
         return pywraplp.Solver.CreateSolver("HIGHS", model_name)
     except TypeError:
-        s = pywraplp.Solver.CreateSolver("HIGHS")
-        s.SetSolverSpecificParametersAsString(f"ModelName={model_name}")
-        return s
+        # 引数が solver_id のみのバージョン。HiGHS には ModelName オプションがなく、設定すると Solve が失敗するためモデル名は付けない
+        return pywraplp.Solver.CreateSolver("HIGHS")
 
 # --- ヘルパー関数 ---
 
@@ -630,6 +629,48 @@ def solve_schedule(schedule_input_data, cleaning_tasks_data):
     return result
 
 # ---------- 2. 残業時間最適配分 (LP) ----------
+def _solve_overtime_greedy(employees_ot_data, total_ot_needed):
+    """
+    残業時間の最適配分を貪欲法で求める
+    制約が「総残業時間の一致」と「個人別の上限」だけの連続ナップサック問題なので、
+    残業コストの安い順に上限まで割り当てれば LP と同じ最適解が得られる (ソルバーの生成・実行が不要)
+    """
+    max_ot_by_id = {}
+    cost_by_id = {}
+    for emp in employees_ot_data:
+        max_ot = emp.get('max_overtime', 0)
+        # 従業員IDがない、または最大残業時間が0以下の場合は割り当て対象にしない (LP版で変数を作らないのと同じ)
+        if 'id' not in emp or max_ot <= 0:
+            add_log('warnings', f"従業員 {emp.get('id', 'ID不明')} は残業の割り当て対象外です (max_overtime <= 0 または IDなし)。", emp)
+            continue
+        max_ot_by_id[emp['id']] = max_ot
+        cost_by_id[emp['id']] = emp.get('overtime_cost', 9999) # 高めのデフォルトコスト
+
+    if not max_ot_by_id: # 残業を割り当て可能な従業員がいない
+        msg = "残業を割り当てる有効な従業員がいませんが、残業が必要です。"
+        add_log('errors', msg)
+        return {'status': 'INFEASIBLE', 'message': msg}
+
+    allocated_by_id = dict.fromkeys(max_ot_by_id, 0)
+    remaining_ot = total_ot_needed
+    objective_value = 0
+    for emp_id in sorted(max_ot_by_id, key=cost_by_id.get): # コストの安い順
+        if remaining_ot <= 0:
+            break
+        allocated = min(max_ot_by_id[emp_id], remaining_ot)
+        allocated_by_id[emp_id] = allocated
+        objective_value += allocated * cost_by_id[emp_id]
+        remaining_ot -= allocated
+
+    if remaining_ot > 1e-9: # 全員の上限まで割り当てても足りない
+        msg = '残業配分問題で解が見つかりませんでした (ステータス: INFEASIBLE)。'
+        add_log('errors', msg, {"status_text": 'INFEASIBLE', "remaining_overtime_hours": remaining_ot})
+        return {'status': 'INFEASIBLE', 'message': msg}
+
+    allocation = [{'id': emp_id, 'overtime_hours': allocated} for emp_id, allocated in allocated_by_id.items()]
+    add_log('overtime', "解が見つかりました (貪欲法)", {"objective": objective_value, "num_allocations": len(allocation)})
+    return {'status': 'OK', 'objective': objective_value, 'allocation': allocation}
+
 def solve_overtime_lp(overtime_input_data):
     """
     残業時間の最適配分をHiGHS LPソルバーを使用して解決する関数
@@ -638,6 +679,7 @@ def solve_overtime_lp(overtime_input_data):
         overtime_input_data: 残業時間の割り当てに必要なデータを含む辞書
             - 'employees': 従業員のリスト (各従業員はID、最大残業時間、残業コストを含む)
             - 'total_overtime_hours': 必要な総残業時間
+            - 'use_lp_solver': True の場合は貪欲法ではなく HiGHS で解く (結果の比較・検証用)
     出力:
         残業時間の割り当て結果を含む辞書
             - 'status': 解のステータス ('OK', 'INFEASIBLE', 'UNBOUNDED', 'NO_DATA', 'SOLVER_ERROR')
@@ -664,6 +706,10 @@ def solve_overtime_lp(overtime_input_data):
         add_log('info', msg)
         return {'status': 'OK', 'objective': 0, 'allocation': [], 'message': msg}
 
+    # 構造が単純な問題なので、通常はソルバーを使わずに貪欲法で解く
+    if not overtime_input_data.get('use_lp_solver', False):
+        return _solve_overtime_greedy(employees_ot_data, total_ot_needed)
+
     # HiGHSソルバーの作成
     solver = _create_highs_solver("overtime_lp")
     if not solver:
@@ -695,6 +741,24 @@ def solve_overtime_lp(overtime_input_data):
         
     add_log('overtime', f"決定変数 (ot_従業員ID) 作成完了 (有効従業員数: {len(x)})")            
 
+    # 解が一意に決まる (または存在しない) 場合はソルバーを実行せずに返す
+    total_ot_capacity = sum(var.ub() for var in x.values())
+    if total_ot_capacity < total_ot_needed - 1e-9: # 全員の上限まで割り当てても足りない
+        msg = '残業配分問題で解が見つかりませんでした (ステータス: INFEASIBLE)。'
+        add_log('errors', msg, {"status_text": 'INFEASIBLE', "total_overtime_capacity": total_ot_capacity})
+        return {'status': 'INFEASIBLE', 'message': msg}
+    if total_ot_capacity <= total_ot_needed + 1e-9: # 全員を上限まで割り当てるしかない
+        cost_by_id = {emp['id']: emp.get('overtime_cost', 9999) for emp in employees_ot_data if emp.get('id') in x}
+        allocation = [{'id': emp_id, 'overtime_hours': var.ub()} for emp_id, var in x.items()]
+        obj_val = sum(cost_by_id[emp_id] * var.ub() for emp_id, var in x.items())
+        add_log('overtime', "解が一意に決まるためソルバーを実行しません", {"objective": obj_val, "num_allocations": len(allocation)})
+        return {'status': 'OK', 'objective': obj_val, 'allocation': allocation}
+    if len(x) == 1: # 対象者が1人なら必要な残業時間をすべて割り当てるしかない
+        (emp_id, var), = x.items()
+        cost = next(emp.get('overtime_cost', 9999) for emp in employees_ot_data if emp.get('id') == emp_id)
+        add_log('overtime', "解が一意に決まるためソルバーを実行しません", {"objective": cost * total_ot_needed, "num_allocations": 1})
+        return {'status': 'OK', 'objective': cost * total_ot_needed, 'allocation': [{'id': emp_id, 'overtime_hours': total_ot_needed}]}
+
     solver.Add(sum(x.values()) == total_ot_needed)
     add_log('overtime', f"総残業時間制約 ({total_ot_needed}時間) 追加完了")
 
@@ -9,32 +9,88 @@ local_main 実行方法:
     python solve_new.py generated_combined_input_data.json > solution.json 2> run_debug.log
 
 """
-import json, sys, math, datetime, os
+import json, sys, math, datetime, os, collections, io, time, gzip, numbers, re
+import concurrent.futures, functools, hashlib, threading, logging, copy
+import numpy as np
 import functions_framework # Cloud Run/Functions 用
 from ortools.sat.python import cp_model
 from ortools.linear_solver import pywraplp
 from google.cloud import storage
+try:
+    import orjson # 高速なJSONエンコード/デコード (インストールされていない環境では標準の json を使う)
+except ImportError:
+    orjson = None
+try:
+    import fastjsonschema # 入力JSONの構造チェック (インストールされていない環境では必須キーの確認のみ行う)
+except ImportError:
+    fastjsonschema = None
 
 # --- グローバル定数 ---
 HOURS_IN_DAY = 24
-MAX_RETRY_ATTEMPTS = 3 # ソフト制約緩和の最大試行回数
-PENALTY_REDUCTION_FACTOR = 0.2 # ペナルティを緩和する際の係数
-DEFAULT_TIME_LIMIT_SEC = 3600 # Cloud Run 用のデフォルト実行時間制限
+DEFAULT_TIME_LIMIT_SEC = 60 # time_limit_sec の指定がない場合のソルバーの制限時間
+TIME_LIMIT_SEC_PATTERN = re.compile(r'[0-9]+(?:\.[0-9]*)?|\.[0-9]+') # クエリ文字列の time_limit_sec として受け付ける表記 ("30" や "0.5" などの非負の10進数)
+DEFAULT_REQUEST_TIMEOUT_SEC = 3600 # デプロイ時のリクエストタイムアウト (Cloud Run の設定値。呼び出し側 cloud_run_trigger.py の timeout とも揃える)
+REQUEST_TIMEOUT_SEC = int(os.environ.get('FUNCTION_TIMEOUT_SEC', DEFAULT_REQUEST_TIMEOUT_SEC)) # プラットフォーム側のリクエストタイムアウト
+MAX_REQUEST_BODY_BYTES = 16 * 1024 * 1024 # これを超えるリクエストボディは JSON として読み込まずに 413 で拒否する
+GCS_UPLOAD_WAIT_TIMEOUT_SEC = 30 # レスポンスを返す前にGCS保存の完了を待つ最大時間 (超えた場合は gcs_save_error として返す)
+RESERVED_POST_SOLVE_SEC = GCS_UPLOAD_WAIT_TIMEOUT_SEC + 5 # 結果の整形とGCS保存のために、タイムアウトまでに残しておく時間
+SOLVER_LOG_MAX_LINES = 200 # verbose_solver_log 有効時に保持するCP-SATログの最大行数 (末尾のみ保持)
+LOG_ENABLED = os.environ.get('SOLVE_LOG_ENABLED', '0') == '1' # add_log による実行ログの記録を行うか (既定は無効で呼び出し直後に戻る。環境変数 SOLVE_LOG_ENABLED=1 で有効化)
+LOG_REDACTED_KEYS = frozenset({'authorization', 'proxy-authorization', 'cookie', 'set-cookie', 'x-api-key', 'token', 'access_token', 'password'}) # ログの details 内でこれらのキー (大文字小文字は区別しない) の値は出力前に伏せる
+LOG_REQUEST_HEADERS = ('Content-Type', 'Content-Length', 'User-Agent') # ログに記録してよいリクエストヘッダ (Authorization や Cookie は記録しない)
+LOG_CATEGORIES = ('schedule', 'overtime', 'errors', 'warnings', 'info')
+INLINE_LOG_CATEGORIES = ('errors', 'warnings') # ログを別保存する場合も結果JSONに残すカテゴリ (呼び出し側がすぐ確認できるように)
+LOG_MAX_ENTRIES_PER_CATEGORY = 10000 # logs の各カテゴリに保持する最大件数 (古いものから捨て、長時間実行でもメモリを一定に保つ)
 GCS_BUCKET_NAME = "shift-optimization-result-storage"  # ★ あなたのGCSバケット名に置き換えてください
 GCS_OBJECT_PREFIX = "result-folder/"   # ★ GCS内の保存先プレフィックス (例: "solver_results/")
-
-_local_full_result_for_testing_only = {
-    'logs': {
-        'schedule': [],
-        'overtime': [],
-        'errors': [],
-        'warnings': [],
-        'info': []
-    },
-    'schedule_result': None,
-    'overtime_result': None,
-    'applied_constraints_history': []
+GCS_CONTENT_TYPE = 'application/json; charset=utf-8'
+JSON_RESPONSE_HEADERS = {'Content-Type': 'application/json; charset=utf-8'} # エラー応答で共通に使うヘッダ (リクエストごとに辞書を作らない)
+GCS_LOG_CONTENT_TYPE = 'application/x-ndjson; charset=utf-8' # ログは結果とは別のオブジェクトに1行1エントリで保存する
+GCS_COMPOSE_PART_SIZE = 8 * 1024 * 1024 # これ以上の大きさの結果は、このサイズのパートに分けて並列アップロードし GCS 上で結合する
+GCS_COMPOSE_MAX_SOURCES = 32 # compose 1回で結合できるオブジェクト数の上限 (GCSの仕様)
+GCS_UPLOAD_MAX_WORKERS = 8 # パートの並列アップロード数
+GCS_BACKGROUND_UPLOAD_WORKERS = 4 # 結果とログのアップロードを並行して行うスレッド数 (レスポンス返却前に完了を待つ)
+GCS_GZIP_COMPRESS_LEVEL = 1 # 結果JSONを gzip 圧縮して保存する際の圧縮レベル (JSONでは1でも十分に縮み、最も速い)
+SOLVE_CACHE_MAX_ENTRIES = 32 # 同一入力に対する最適解をインスタンス内に保持する件数 (古いものから捨てる)
+SOLVE_CACHE_TTL_SEC = 600 # キャッシュした最適解の有効期間
+SOLVER_INT_SETTING_RANGES = { # ソルバーに渡す整数の settings と、その許容範囲 (範囲外や整数以外は 400 で拒否する)
+    'num_workers': (1, 2**31 - 1), # 実際のワーカー数はさらに CPU 数で頭打ちにする
+    'random_seed': (0, 2**31 - 1),
+    'core_minimization_level': (0, 2), # CP-SAT が受け付ける範囲
+    'linearization_level': (0, 2)
+}
+PROGRESS_LOG_LEVEL = os.environ.get('SOLVE_LOG_LEVEL', 'WARNING') # 進捗メッセージ (ソルバー開始/終了・GCS保存完了) の出力レベル。本番では WARNING にして出力しない
+
+# 入力JSON (combined_input_data.json と同じ構造) のスキーマ。ソルバーを動かす前に必須の構造をまとめて検証する
+COMBINED_INPUT_SCHEMA = {
+    "type": "object",
+    "required": ["schedule_input", "cleaning_tasks_input"],
+    "properties": {
+        "schedule_input": {
+            "type": "object",
+            "required": ["settings", "facilities", "employees"],
+            "properties": {
+                "settings": {"type": "object"},
+                "facilities": {
+                    "type": "array",
+                    "items": {"type": "object", "required": ["id"]}
+                },
+                "employees": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["id"],
+                        "properties": {"availability": {"type": "array"}}
+                    }
+                }
+            }
+        },
+        "cleaning_tasks_input": {"type": "object", "minProperties": 1}
+    }
 }
+# スキーマは一度だけコンパイルし、リクエストごとに使い回す
+COMBINED_INPUT_VALIDATOR = fastjsonschema.compile(COMBINED_INPUT_SCHEMA) if fastjsonschema is not None else None
+
 CP_SOLVER_STATUS_MAP = {
     cp_model.OPTIMAL: 'OPTIMAL',
     cp_model.FEASIBLE: 'FEASIBLE',
@@ -42,6 +98,16 @@ CP_SOLVER_STATUS_MAP = {
     cp_model.MODEL_INVALID: 'MODEL_INVALID',
     cp_model.UNKNOWN: 'UNKNOWN'
 }
+# スケジュール結果のステータスごとのHTTPステータスコード
+# UNKNOWN は制限時間内に解が見つからなかった場合なので 504 (呼び出し側が時間を延ばして再試行できるようにする)
+# 422 と 504 でも本文には結果全体が入る (入力の不備はスキーマ検証で先に 400 を返すため、ここには含めない)
+SCHEDULE_STATUS_HTTP_CODE_MAP = {
+    'OPTIMAL': 200,
+    'FEASIBLE': 200,
+    'UNKNOWN': 504,
+    'INFEASIBLE': 422,
+    'MODEL_INVALID': 500
+}
 
 # --- HiGHSソルバー生成ユーティリティ ---
 # def _create_highs_solver(model_name="model"):
@@ -52,33 +118,129 @@ CP_SOLVER_STATUS_MAP = {
 #         s.SetSolverSpecificParametersAsString(f"ModelName={model_name}")
 #         return s
 
+# --- ログ関連ヘルパー関数 ---
+# 進捗メッセージは print ではなくこのロガーで標準エラーに出す (レベルが足りなければ整形も書き込みも行われない)
+progress_logger = logging.getLogger('solve_new')
+progress_logger.setLevel(PROGRESS_LOG_LEVEL)
+progress_logger.propagate = False # ルートロガー (Functions Framework の設定) に二重に出力しない
+if not progress_logger.handlers:
+    progress_logger.addHandler(logging.StreamHandler(sys.stderr))
+
+def create_empty_logs():
+    """カテゴリごとに件数上限付きの deque を持つ logs 辞書を作る (JSON化の際は list として出力される)"""
+    return {category: collections.deque(maxlen=LOG_MAX_ENTRIES_PER_CATEGORY) for category in LOG_CATEGORIES}
+
+def redact_log_value(value):
+    """ログの details を再帰的にたどり、LOG_REDACTED_KEYS に該当するキーの値を伏せたコピーを返す"""
+    if isinstance(value, dict):
+        return {key: "[REDACTED]" if str(key).lower() in LOG_REDACTED_KEYS else redact_log_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact_log_value(item) for item in value]
+    return value
+
+def format_log_entry(entry):
+    """ログエントリの timestamp (time.time() の値) を ISO 8601 文字列にし、機密情報を伏せたコピーを返す (整形はシリアライズ時にだけ行う)"""
+    return {**redact_log_value(entry), "timestamp": datetime.datetime.fromtimestamp(entry["timestamp"]).isoformat()}
+
+def format_logs(logs):
+    """logs 辞書の全エントリの timestamp を ISO 8601 文字列にした辞書を返す (エラーレスポンスにログを含める場合用)"""
+    return {category: [format_log_entry(entry) for entry in entries] for category, entries in logs.items()}
+
+def get_inline_logs(logs):
+    """結果JSONに残すカテゴリ (INLINE_LOG_CATEGORIES) のログだけを timestamp 整形済みで返す"""
+    return format_logs({category: logs[category] for category in INLINE_LOG_CATEGORIES})
+
+def dumps_logs_ndjson_bytes(logs):
+    """logs 辞書を1行1エントリの NDJSON バイト列に変換する (各行に category を付ける)"""
+    return b''.join(dumps_json_bytes({"category": category, **format_log_entry(entry)}) + b'\n' for category, entries in logs.items() for entry in entries)
+
+def count_logs(logs):
+    """logs 辞書のカテゴリごとの件数を返す (結果JSONにはログ本体の代わりにこれを含める)"""
+    return {category: len(entries) for category, entries in logs.items()}
+
+# --- 入力検証ヘルパー関数 ---
+def get_valid_time_limit_sec(value):
+    """time_limit_sec として有効な値 (正の有限な実数。bool は除く) ならその値を、そうでなければ None を返す (文字列は実数として解釈する)"""
+    if isinstance(value, str):
+        # try/except を使わず、正規表現で数値表記か確認してから変換する (ASCII の数字のみなので float() は失敗しない)
+        if not TIME_LIMIT_SEC_PATTERN.fullmatch(value):
+            return None
+        value = float(value)
+    if isinstance(value, bool) or not isinstance(value, numbers.Real) or not math.isfinite(value) or value <= 0:
+        return None
+    return value
+
+def get_combined_input_error(combined_input_data):
+    """入力JSONの構造を検証し、問題があればエラーメッセージを、問題がなければ None を返す"""
+    if COMBINED_INPUT_VALIDATOR is not None:
+        try:
+            COMBINED_INPUT_VALIDATOR(combined_input_data)
+        except fastjsonschema.JsonSchemaException as e:
+            return f"入力JSONの形式が不正です: {e.message}"
+        return get_solver_settings_error(combined_input_data["schedule_input"]["settings"])
+    # fastjsonschema がない場合は必須キーの有無だけ確認する
+    if not isinstance(combined_input_data, dict) or not combined_input_data.get("schedule_input") or not combined_input_data.get("cleaning_tasks_input"):
+        return "入力JSONに必要なキー 'schedule_input' または 'cleaning_tasks_input' がありません。"
+    if not all(key in combined_input_data["schedule_input"] for key in ('settings', 'facilities', 'employees')):
+        return 'スケジューリングに必要な基本データ（settings, facilities, employees）が不足しています。'
+    return get_solver_settings_error(combined_input_data["schedule_input"]["settings"])
+
+def get_solver_settings_error(settings):
+    """ソルバーに渡す整数の settings (SOLVER_INT_SETTING_RANGES) を検証し、問題があればエラーメッセージを、なければ None を返す"""
+    if not isinstance(settings, dict):
+        return "settings はオブジェクトで指定してください。"
+    for key, (min_value, max_value) in SOLVER_INT_SETTING_RANGES.items():
+        value = settings.get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, int) or not min_value <= value <= max_value:
+            return f"settings.{key} は {min_value} 以上 {max_value} 以下の整数で指定してください ({value!r})。"
+    return None
+
+# --- JSON関連ヘルパー関数 ---
+def dumps_json_bytes(obj, indent=False):
+    """obj を UTF-8 の JSON バイト列に変換する (orjson があれば使用)"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if indent: option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option, default=list)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False, default=list).encode('utf-8')
+
+def loads_json(data):
+    """JSON のバイト列/文字列を読み込む (orjson があれば使用。不正な JSON では JSONDecodeError、標準の json では不正な UTF-8 で UnicodeDecodeError を送出)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 # --- ログ関連ヘルパー関数 ---
 def add_log(full_result_ref, category, message, details=None):
-    """汎用ログ追加関数"""
-    return
-    # log_entry = {"timestamp": datetime.datetime.now().isoformat(), "message": message}
-    # if details:
-    #     log_entry["details"] = details
+    """
+    汎用ログ追加関数 (LOG_ENABLED が False の場合は何もしない)
+    引数の組み立て自体が重い呼び出し (リクエストヘッダの抽出等) は、呼び出し側でも LOG_ENABLED を確認すること
+    """
+    if not LOG_ENABLED:
+        return
+    log_entry = {"timestamp": time.time(), "message": message} # 文字列への整形は出力時 (format_log_entry) に行う
+    if details:
+        log_entry["details"] = details
     
-    # # HTTP関数の場合、最初に初期化されることを想定。ローカルでは事前に初期化済み。
-    # if 'logs' not in full_result_ref: 
-    #     full_result_ref['logs'] = {'schedule': [], 'overtime': [], 'errors': [], 'warnings': [], 'info': []}
+    # HTTP関数の場合、最初に初期化されることを想定。ローカルでは事前に初期化済み。
+    if 'logs' not in full_result_ref: 
+        full_result_ref['logs'] = create_empty_logs()
     
-    # if category in full_result_ref['logs']:
-    #     full_result_ref['logs'][category].append(log_entry)
-    # else:
-    #     error_log_entry = {
-    #         "timestamp": datetime.datetime.now().isoformat(),
-    #         "message": f"未知のログカテゴリ: {category}",
-    #         "original_message": message
-    #     }
-    #     if details: error_log_entry["original_details"] = details
-    #     # 未知のカテゴリもエラーログに記録する
-    #     if 'errors' not in full_result_ref['logs']: # errorsキーがない場合も考慮
-    #          full_result_ref['logs']['errors'] = []
-    #     full_result_ref['logs']['errors'].append(error_log_entry)
-    #     # 標準エラーにも警告を出すのは良いプラクティス
-    #     print(f"警告(ログ): 未知のログカテゴリ '{category}' ({message}) が使用されました。", file=sys.stderr)
+    if category in full_result_ref['logs']:
+        full_result_ref['logs'][category].append(log_entry)
+    else:
+        error_log_entry = {
+            "timestamp": time.time(),
+            "message": f"未知のログカテゴリ: {category}",
+            "original_message": message
+        }
+        if details: error_log_entry["original_details"] = details
+        # 未知のカテゴリもエラーログに記録する
+        full_result_ref['logs']['errors'].append(error_log_entry)
+        # 標準エラーにも警告を出すのは良いプラクティス
+        print(f"警告(ログ): 未知のログカテゴリ '{category}' ({message}) が使用されました。", file=sys.stderr)
 
 def add_model_stats_log(full_result_ref, model_instance, category, event_message):
     """モデルの統計情報をログに記録するヘルパー関数"""
@@ -114,9 +276,21 @@ def parse_time_to_int(full_result_ref, time_str): # full_result_ref を追加
         raise ValueError(f"無効な時間形式: {time_str}") from e
 
 def get_employee_availability_matrix(full_result_ref, employees_data, num_total_days, days_of_week_order, planning_start_date_obj): # full_result_ref を追加
-    availability_matrix = {} # (emp_idx, day_idx, hour_idx) -> True
+    """
+    従業員の勤務可能時間を (従業員, 日, 時間) のブール配列で返す
+    スロットごとに、該当する曜日の日をまとめてスライス代入する
+    """
+    availability_matrix = np.zeros((len(employees_data), num_total_days, HOURS_IN_DAY), dtype=bool) # [emp_idx, day_idx, hour_idx]
     night_shift_details_map = {}
 
+    # 計画期間内の各日の曜日文字列を一度だけ計算し、曜日ごとの日インデックスに振り分けておく
+    dow_str_per_day = [days_of_week_order[(planning_start_date_obj + datetime.timedelta(days=d)).weekday()] for d in range(num_total_days)]
+    days_by_dow = {}
+    for d, dow_str in enumerate(dow_str_per_day):
+        days_by_dow.setdefault(dow_str, []).append(d)
+    days_by_dow = {dow_str: np.array(day_list, dtype=np.intp) for dow_str, day_list in days_by_dow.items()}
+    no_days = np.zeros(0, dtype=np.intp)
+
     for emp_idx, emp in enumerate(employees_data):
         for avail_slot in emp.get('availability', []):
             try:
@@ -125,39 +299,29 @@ def get_employee_availability_matrix(full_result_ref, employees_data, num_total_
                 end_hour_int = parse_time_to_int(full_result_ref, avail_slot['end_time'])
                 is_night_shift = avail_slot.get('is_night_shift', False)
 
-                for day_idx_in_planning in range(num_total_days): # 計画期間内のすべての日をチェック
-                    current_date = planning_start_date_obj + datetime.timedelta(days=day_idx_in_planning)
-                    current_day_of_week_str = days_of_week_order[current_date.weekday()]
-
-                    if current_day_of_week_str == day_of_week_spec: # スロットが定義された曜日と一致
-                        # この day_idx_in_planning がスロットの開始日
-                        if is_night_shift and end_hour_int < start_hour_int: # 日付またぎ夜勤
-                            # 当日分
-                            for h_today in range(start_hour_int, 24):
-                                if 0 <= h_today < HOURS_IN_DAY:
-                                    availability_matrix[(emp_idx, day_idx_in_planning, h_today)] = True
-                            # 翌日分 (計画期間内であれば)
-                            if day_idx_in_planning + 1 < num_total_days:
-                                next_day_idx_in_planning = day_idx_in_planning + 1
-                                for h_next_day in range(0, end_hour_int):
-                                    if 0 <= h_next_day < HOURS_IN_DAY:
-                                        availability_matrix[(emp_idx, next_day_idx_in_planning, h_next_day)] = True
-                                # 夜勤詳細を記録 (開始日基準)
-                                night_shift_details_map[(emp_idx, day_idx_in_planning)] = {
-                                    "start_hour_on_start_day": start_hour_int,
-                                    "end_hour_on_next_day": end_hour_int, # 翌日の終了時刻 (0-23)
-                                    "is_night_shift": True
-                                }
-                        else: # 通常の日中シフトまたは日付をまたがない夜勤 (例: 22:00-24:00)
-                            for hour_idx in range(start_hour_int, end_hour_int):
-                                if 0 <= hour_idx < HOURS_IN_DAY:
-                                    availability_matrix[(emp_idx, day_idx_in_planning, hour_idx)] = True
-                            if is_night_shift: # 日付はまたがないが夜勤フラグがついている場合
-                                night_shift_details_map[(emp_idx, day_idx_in_planning)] = {
-                                    "start_hour_on_start_day": start_hour_int,
-                                    "end_hour_on_start_day": end_hour_int,
-                                    "is_night_shift": True
-                                }
+                slot_days = days_by_dow.get(day_of_week_spec, no_days) # スロットが定義された曜日に一致する日 (スロットの開始日)
+                if is_night_shift and end_hour_int < start_hour_int: # 日付またぎ夜勤
+                    # 当日分
+                    availability_matrix[emp_idx, slot_days, max(start_hour_int, 0):HOURS_IN_DAY] = True
+                    # 翌日分 (計画期間内であれば)
+                    next_days = slot_days[slot_days + 1 < num_total_days]
+                    availability_matrix[emp_idx, next_days + 1, 0:max(min(end_hour_int, HOURS_IN_DAY), 0)] = True
+                    # 夜勤詳細を記録 (開始日基準)
+                    for day_idx_in_planning in next_days.tolist():
+                        night_shift_details_map[(emp_idx, day_idx_in_planning)] = {
+                            "start_hour_on_start_day": start_hour_int,
+                            "end_hour_on_next_day": end_hour_int, # 翌日の終了時刻 (0-23)
+                            "is_night_shift": True
+                        }
+                else: # 通常の日中シフトまたは日付をまたがない夜勤 (例: 22:00-24:00)
+                    availability_matrix[emp_idx, slot_days, max(start_hour_int, 0):max(min(end_hour_int, HOURS_IN_DAY), 0)] = True
+                    if is_night_shift: # 日付はまたがないが夜勤フラグがついている場合
+                        for day_idx_in_planning in slot_days.tolist():
+                            night_shift_details_map[(emp_idx, day_idx_in_planning)] = {
+                                "start_hour_on_start_day": start_hour_int,
+                                "end_hour_on_start_day": end_hour_int,
+                                "is_night_shift": True
+                            }
 
             except KeyError as e: add_log(full_result_ref, 'warnings', f"従業員 {emp.get('id', 'N/A')} の勤務可能時間データにキーエラー: {e}", {"employee_id": emp.get('id')})
             except ValueError as e: add_log(full_result_ref, 'warnings', f"従業員 {emp.get('id', 'N/A')} の時間関連データエラー: {e}", {"employee_id": emp.get('id')})
@@ -195,19 +359,150 @@ def get_effective_penalty(base_penalty_config, global_multiplier, facility_overr
     # print(f"Debug: Global penalty used: {base_val * global_multiplier}")
     return base_val * global_multiplier
 
+def get_boolean_values(solver, bool_vars):
+    """
+    ブール変数リストの解を bool の numpy 配列として一括取得する（OR-Toolsバージョン差異を吸収）
+    """
+    try:
+        # BooleanValues が使えるバージョン用 (pandas.Series が返る)
+        return solver.BooleanValues(bool_vars).to_numpy(dtype=bool)
+    except AttributeError:
+        # 古いバージョン用
+        return np.fromiter((solver.BooleanValue(v) for v in bool_vars), dtype=bool, count=len(bool_vars))
+
+def get_slot_covered_hours(full_result_ref, slot, dow_str_per_day):
+    """availability スロットが計画期間内でカバーする (d,h) の一覧を返す (y変数とx変数の連携制約と同じ判定)"""
+    start_h = parse_time_to_int(full_result_ref, slot['start_time'])
+    end_h = parse_time_to_int(full_result_ref, slot['end_time'])
+    is_overnight = slot.get('is_night_shift', False) and end_h < start_h # 日またぎ
+    covered_hours = []
+    for d_idx, dow_str in enumerate(dow_str_per_day):
+        if dow_str == slot['day_of_week']:
+            covered_hours.extend((d_idx, h_idx) for h_idx in range(start_h, 24 if is_overnight else end_h))
+        elif is_overnight and d_idx > 0 and dow_str_per_day[d_idx - 1] == slot['day_of_week']: # 翌日分
+            covered_hours.extend((d_idx, h_idx) for h_idx in range(0, end_h))
+    return covered_hours
+
+def build_greedy_hint(slots_covered_hours, slots_employee_idx, slots_target_facilities, required_staff_arr, num_employees, max_weekly_hours, min_rest_hours):
+    """
+    ソルバーに与えるヒント用の初期解を貪欲法で作る
+    各 availability スロットについて、未充足の必要人数を最も多く埋められる施設に割り当てる。
+    週の最大労働時間・同時刻の重複勤務・勤務間インターバルを満たさない割り当ては行わない。
+    戻り値: {slot_idx: f_idx}
+    """
+    num_facilities, num_total_days, hours_in_day = required_staff_arr.shape
+    remaining_staff = required_staff_arr.astype(np.int64) # 未充足の必要人数
+    works_at = np.zeros((num_employees, num_total_days * hours_in_day), dtype=bool) # 従業員ごとの勤務時間 (全期間を1次元で)
+    slot_assignment = {}
+
+    for slot_idx, covered_hours in enumerate(slots_covered_hours):
+        if not covered_hours:
+            continue
+        w_idx = slots_employee_idx[slot_idx]
+        d_arr, h_arr = np.array(covered_hours).T
+        global_h_arr = d_arr * hours_in_day + h_arr
+        if works_at[w_idx, global_h_arr].any(): # 既に割り当て済みの時間と重複
+            continue
+
+        candidate_works_at = works_at[w_idx].copy()
+        candidate_works_at[global_h_arr] = True
+        # 週の最大労働時間 (7日ごとのブロック)
+        hours_per_day = candidate_works_at.reshape(num_total_days, hours_in_day).sum(axis=1)
+        if np.add.reduceat(hours_per_day, np.arange(0, num_total_days, 7)).max() > max_weekly_hours:
+            continue
+        # 勤務間インターバル (勤務ブロック間の非勤務時間が min_rest_hours - 1 時間以上)
+        edges = np.diff(np.concatenate(([0], candidate_works_at.astype(np.int8), [0])))
+        block_starts, block_ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+        if (block_starts[1:] - block_ends[:-1] < min_rest_hours - 1).any():
+            continue
+
+        best_f_idx, best_gain = None, 0
+        for f_idx in slots_target_facilities[slot_idx]:
+            gain = int((remaining_staff[f_idx, d_arr, h_arr] > 0).sum())
+            if gain > best_gain:
+                best_f_idx, best_gain = f_idx, gain
+        if best_f_idx is None:
+            continue
+
+        remaining_staff[best_f_idx, d_arr, h_arr] -= 1
+        works_at[w_idx] = candidate_works_at
+        slot_assignment[slot_idx] = best_f_idx
+
+    return slot_assignment
+
+def prepare_shortage_penalties(difficulty_score_arr, cleaning_tasks_arr, facility_capacity_arr, facility_base_penalty_arr,
+                               cleaning_start_h, cleaning_end_h, cleaning_shift_shortage_multiplier, apply_difficulty, scale_factor):
+    """
+    スタッフ不足制約用の配列を入力配列から一括で計算する (CP-SATのモデル構築とは独立した数値計算のみ)
+    戻り値: (required_staff_arr[f,d,h] int32, shortage_penalty_arr[f,d,h] int64)
+    """
+    num_facilities, num_total_days, hours_in_day = difficulty_score_arr.shape
+    cleaning_hours_duration = cleaning_end_h - cleaning_start_h
+
+    # 清掃時間帯は清掃タスク数から必要人数を算出 (タスクが0以下でも最低1名)、それ以外の時間帯は1名
+    required_staff_arr = np.ones((num_facilities, num_total_days, hours_in_day), dtype=np.int32)
+    cleaning_hour_start_idx, cleaning_hour_end_idx = max(0, cleaning_start_h), min(hours_in_day, cleaning_end_h)
+    if cleaning_hours_duration > 0 and cleaning_hour_start_idx < cleaning_hour_end_idx:
+        required_cleaning_staff = np.maximum(1, np.ceil(cleaning_tasks_arr / (facility_capacity_arr[:, None] * cleaning_hours_duration)))
+        required_staff_arr[:, :, cleaning_hour_start_idx:cleaning_hour_end_idx] = required_cleaning_staff[:, :, None]
+
+    # ★コンテキストによる難易度スコアの精緻化
+    # 清掃シフト時間帯以外の不足はより重大と見なす（常駐義務違反）
+    # 他の重要なコンテキスト（例: イベント日など）もここに追加可能
+    hours_arr = np.arange(hours_in_day)
+    context_multiplier_arr = np.where((cleaning_start_h >= hours_arr) & (hours_arr > cleaning_end_h), cleaning_shift_shortage_multiplier, 1.0)
+
+    # 最終的なペナルティ係数を整数化 (難易度スコアは scale_factor 倍済みなので、そのまま掛ければよい)
+    if apply_difficulty:
+        shortage_penalty_arr = facility_base_penalty_arr[:, None, None] * (difficulty_score_arr * context_multiplier_arr[None, None, :])
+    else:
+        shortage_penalty_arr = np.broadcast_to(facility_base_penalty_arr[:, None, None] * scale_factor, difficulty_score_arr.shape)
+    shortage_penalty_arr = np.round(shortage_penalty_arr).astype(np.int64)
+
+    return required_staff_arr, shortage_penalty_arr
+
+
+def build_constraints_settings(settings, run_id):
+    """適用した制約設定 (ハード制約の一覧とソフト制約のペナルティ) を記録用の辞書として作成する"""
+    return {
+        "run_id": run_id,
+        "hard_constraints": [
+            "employee_availability_and_preferred_facility",
+            "employee_one_facility_at_a_time",
+            "works_on_day_definition",
+            "overnight_shift_continuity", # 夜勤連続性
+            "max_weekly_hours_40",        # 週40時間
+            "min_rest_interval_8h",       # 勤務間インターバル
+            "no_facility_change_within_day" # 同日施設変更禁止(近似)
+        ],
+        "soft_constraints_settings": {
+            "consecutive_days": {
+                "base_penalty": settings.get('consecutive_days_penalty', 20000)
+            },
+            "weekly_days": {
+                "base_penalty": settings.get('weekly_days_penalty', 10000)
+            },
+            "daily_hours": {
+                "base_penalty": settings.get('daily_hours_penalty', 30000)
+            },
+            "staff_shortage": {
+                "base_penalty": settings.get('staff_shortage_penalty', 50000),
+                "apply_difficulty_score_to_shortage": True
+            },
+            "difficulty_fairness": {
+                "base_penalty": settings.get('fairness_penalty_weight_difficulty', 1000)
+            }
+        }
+    }
+
 
 # ---------- 1. シフトスケジューリング (CP-SAT) ----------
-def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, time_limit_sec, retry_attempt=0, penalty_multipliers=None):
+def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, time_limit_sec):
     """
-    シフトスケジューリングを行う関数 (ソフト制約緩和による再試行ロジックを含む)
+    シフトスケジューリングを行う関数
     """
-    run_id = f"attempt_{retry_attempt}_{datetime.datetime.now().strftime('%H%M%S%f')}"
-    add_log(full_result_ref, 'info', f"[{run_id}] シフトスケジューリング処理開始 (試行回数: {retry_attempt})", {"penalty_multipliers": penalty_multipliers})
-    
-    if penalty_multipliers is None:
-        penalty_multipliers = {
-            "consecutive_days": 1.0, "weekly_days": 1.0, "daily_hours": 1.0, "staff_shortage": 1.0
-        }
+    run_id = f"schedule_{datetime.datetime.now().strftime('%H%M%S%f')}"
+    add_log(full_result_ref, 'info', f"[{run_id}] シフトスケジューリング処理開始")
 
     settings = schedule_input_data['settings']
     facilities_data = schedule_input_data['facilities']
@@ -232,11 +527,11 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
     planning_start_date_obj = datetime.datetime.strptime(settings['planning_start_date'], "%Y-%m-%d").date()
     num_total_days = settings['num_days_in_planning_period']
     D_indices = range(num_total_days)
+    planning_dates = [planning_start_date_obj + datetime.timedelta(days=d_idx) for d_idx in D_indices] # 日付の計算は一度だけ行い、以降はこのリストを使う
     days_of_week_order = settings.get('days_of_week_order', ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"])
     H_indices = range(HOURS_IN_DAY)
     cleaning_start_h = settings['cleaning_shift_start_hour']
     cleaning_end_h = settings['cleaning_shift_end_hour'] 
-    cleaning_hours_duration = cleaning_end_h - cleaning_start_h
 
     # availability の各スロットにユニークなインデックスを付ける
     all_availability_slots = []
@@ -257,102 +552,108 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
         night_hours.update(range(night_start_difficulty, 24))
         night_hours.update(range(0, night_end_difficulty))
 
-    # 各シフト (f,d,h) の難易度スコアを事前に計算
-    difficulty_score_map = {}
-    for f_idx in F_indices: # 現状、施設による難易度変動は入れていないが拡張可能
-        for d_idx in D_indices:
-            current_date_obj = planning_start_date_obj + datetime.timedelta(days=d_idx)
-            day_of_week_val = current_date_obj.weekday() # 月曜=0, 土曜=5, 日曜=6
-            
-            is_weekend = (day_of_week_val == 5 or day_of_week_val == 6)
-
-            for h_idx in H_indices:
-                score = float(base_score_ph) # floatで計算開始
-                if h_idx in night_hours:
-                    score *= night_multi
-                if is_weekend:
-                    score *= weekend_multi
-                difficulty_score_map[(f_idx, d_idx, h_idx)] = score # floatで保持
+    # スケールファクタを定義
+    # ここでは、浮動小数点数スコア（コスト）を1000倍して整数として扱う        
+    SCALE_FACTOR = 1000 # 1000なら小数点数3位までのコスト精度を確保
+
+    # 各シフト (f,d,h) の難易度スコアを SCALE_FACTOR 倍した整数 (int32) で事前に計算
+    # CP-SATの係数は整数なので、最初から整数で保持して後段での float→int 変換を不要にする
+    night_multi_int = int(round(night_multi * SCALE_FACTOR))
+    weekend_multi_int = int(round(weekend_multi * SCALE_FACTOR))
+    night_hours_mask = np.zeros(HOURS_IN_DAY, dtype=bool)
+    night_hours_mask[[h for h in night_hours if 0 <= h < HOURS_IN_DAY]] = True
+    weekend_days_mask = np.array([current_date.weekday() >= 5 for current_date in planning_dates], dtype=bool) # 土曜=5, 日曜=6
+    # 現状、施設による難易度変動は入れていないが拡張可能なように (f,d,h) の形で保持
+    scores = np.full((num_facilities, num_total_days, HOURS_IN_DAY), int(round(base_score_ph * SCALE_FACTOR)), dtype=np.int64)
+    scores[:, :, night_hours_mask] = scores[:, :, night_hours_mask] * night_multi_int // SCALE_FACTOR
+    scores[:, weekend_days_mask, :] = scores[:, weekend_days_mask, :] * weekend_multi_int // SCALE_FACTOR
+    difficulty_score_arr = scores.astype(np.int32)
     
     emp_avail_matrix, night_shift_details_map = get_employee_availability_matrix(full_result_ref, employees_data, num_total_days, days_of_week_order, planning_start_date_obj) # ★変更
     add_log(full_result_ref, 'info', f"[{run_id}] 従業員の勤務可能時間マトリックス作成完了")
 
-    emp_preferred_facilities_idx_sets = [
-        set(facility_id_to_idx[fid] for fid in emp.get('preferred_facilities', []) if fid in facility_id_to_idx)
-        for emp in employees_data
-    ]
+    # 従業員ごとの属性は制約構築ループで dict の .get を繰り返さないよう、ここで配列にまとめておく
+    # pref_mask[w, f]: 従業員wが施設fで勤務できるか (希望施設の指定がない従業員は全施設 True)
+    pref_mask = np.zeros((num_employees, num_facilities), dtype=np.bool_)
+    for w_idx, emp in enumerate(employees_data):
+        preferred_f_indices = [facility_id_to_idx[fid] for fid in emp.get('preferred_facilities', []) if fid in facility_id_to_idx]
+        pref_mask[w_idx, preferred_f_indices if preferred_f_indices else slice(None)] = True
+    emp_target_facilities = [np.flatnonzero(pref_mask[w_idx]).tolist() for w_idx in W_indices]
+    max_days_week_arr = np.array([emp.get('contract_max_days_per_week', 7) for emp in employees_data], dtype=np.int32).reshape(num_employees)
+    max_hours_day_arr = np.array([emp.get('contract_max_hours_per_day', HOURS_IN_DAY) for emp in employees_data], dtype=np.int32).reshape(num_employees)
 
     # --- モデルと変数定義 ---
 
     model = cp_model.CpModel()
+    # 制約構築ループで頻繁に呼ぶメソッドはローカル変数に束縛しておく (属性参照を毎回行わないため)
+    model_Add = model.Add
+    model_NewBoolVar = model.NewBoolVar
+    model_NewIntVar = model.NewIntVar
+    model_AddBoolOr = model.AddBoolOr
+    model_AddImplication = model.AddImplication
+    model_AddMaxEquality = model.AddMaxEquality
+    LinearExpr_Sum = cp_model.LinearExpr.Sum
     add_log(full_result_ref, 'schedule', f"[{run_id}] CP-SATモデルオブジェクト作成完了")
 
-    # --- 決定変数 (疎な生成) ---
-    # x[f, w, d, h]: 従業員wが施設fに日dの時間hに勤務するか
-    # 勤務可能なスロットに対してのみ変数を生成する
-    x = {} 
-    for w_idx in W_indices:
-        preferred_facilities_for_w = emp_preferred_facilities_idx_sets[w_idx]
-        target_facilities = F_indices if not preferred_facilities_for_w else preferred_facilities_for_w
-        for d_idx in D_indices:
-            for h_idx in H_indices:
-                if emp_avail_matrix.get((w_idx, d_idx, h_idx), False):
-                    for f_idx in target_facilities:
-                        x[(f_idx, w_idx, d_idx, h_idx)] = model.NewBoolVar(f'x_{f_idx}_{w_idx}_{d_idx}_{h_idx}')
-    add_log(full_result_ref, 'schedule', f"[{run_id}] 決定変数 (x) の疎な生成完了", {"num_x_vars": len(x)})
-
-    # 新しい決定変数 y[slot_idx, f] の生成
+    # 各 availability スロットがカバーする (d,h) と、(w,d,h) をカバーするスロットの一覧を一度だけ求めておく
+    dow_str_per_day = [days_of_week_order[current_date.weekday()] for current_date in planning_dates]
+    slots_covered_hours = [get_slot_covered_hours(full_result_ref, slot, dow_str_per_day) for slot in all_availability_slots]
+    slots_employee_idx = [slot['employee_idx'] for slot in all_availability_slots]
+    slots_target_facilities = [emp_target_facilities[w_idx] for w_idx in slots_employee_idx]
+    covering_slots_by_wdh = collections.defaultdict(list) # (w,d,h) -> その時間をカバーするスロット
+    for slot_idx, covered_hours in enumerate(slots_covered_hours):
+        w_idx = slots_employee_idx[slot_idx]
+        for d_idx, h_idx in covered_hours:
+            covering_slots_by_wdh[w_idx, d_idx, h_idx].append(slot_idx)
+
+    # --- 決定変数 ---
+    # 実際の意思決定はスロット単位の y[slot_idx, f] (スロットをどの施設で勤務するか) で行う
     y = {} 
-    for slot in all_availability_slots:
-        w_idx = slot['employee_idx']; slot_idx = slot['global_slot_idx']
-        preferred_facilities_for_w = emp_preferred_facilities_idx_sets[w_idx]
-        target_facilities = F_indices if not preferred_facilities_for_w else preferred_facilities_for_w
+    for slot_idx, target_facilities in enumerate(slots_target_facilities):
         for f_idx in target_facilities:
-            y[(slot_idx, f_idx)] = model.NewBoolVar(f'y_slot{slot_idx}_fac{f_idx}')
+            y[(slot_idx, f_idx)] = model_NewBoolVar(f'y_slot{slot_idx}_fac{f_idx}')
     add_log(full_result_ref, 'schedule', f"[{run_id}] 決定変数 (y) の生成完了", {"num_y_vars": len(y)})
 
+    # x[f, w, d, h]: 従業員wが施設fに日dの時間hに勤務するか (= その時間をカバーする y[slot, f] のいずれかが1)
+    # 勤務可能なスロットに対してのみ定義する。カバーするスロットが1つだけの時間 (ほとんどの場合) は新しい変数を作らず
+    # その y 変数をそのまま使い、複数のスロットが重なる時間だけ x <=> OR(y) の補助変数を作る
+    x = {} 
+    for w_idx, d_idx, h_idx in np.argwhere(emp_avail_matrix).tolist(): # 勤務可能な (w,d,h) のみを (w,d,h) の順に走査
+        covering_slots = covering_slots_by_wdh.get((w_idx, d_idx, h_idx), ())
+        for f_idx in emp_target_facilities[w_idx]:
+            possible_y_vars = [y[slot_idx, f_idx] for slot_idx in covering_slots]
+            if not possible_y_vars: # このxをカバーするyが存在しない (常に0なので変数を作らない)
+                continue
+            if len(possible_y_vars) == 1:
+                x[(f_idx, w_idx, d_idx, h_idx)] = possible_y_vars[0]
+                continue
+            x_var = model_NewBoolVar(f'x_{f_idx}_{w_idx}_{d_idx}_{h_idx}')
+            model_AddBoolOr(possible_y_vars + [x_var.Not()])
+            for y_var in possible_y_vars:
+                model_AddImplication(y_var, x_var)
+            x[(f_idx, w_idx, d_idx, h_idx)] = x_var
+    add_log(full_result_ref, 'schedule', f"[{run_id}] 決定変数 (x) の疎な生成完了", {"num_x_vars": len(x)})
+
+    # 集計軸ごとに x を一度だけ振り分けておく (存在しないキーへの x.get を繰り返さないため)
+    x_by_wd = {(w, d): [] for w in W_indices for d in D_indices}     # (w,d)   -> その日の全施設・全時間の変数
+    x_by_fdh = {(f, d, h): [] for f in F_indices for d in D_indices for h in H_indices} # (f,d,h) -> その枠の全従業員の変数
+    x_by_wdh = collections.defaultdict(list) # (w,d,h) -> その時間の全施設の変数 (勤務可能な時間のみキーを持つ)
+    for (f_idx, w_idx, d_idx, h_idx), x_var in x.items():
+        x_by_wd[w_idx, d_idx].append(x_var)
+        x_by_fdh[f_idx, d_idx, h_idx].append(x_var)
+        x_by_wdh[w_idx, d_idx, h_idx].append(x_var)
+
     # --- 補助変数 ---
     # works_on_day は従業員と日ごと
-    works_on_day = { (w,d): model.NewBoolVar(f'works_w{w}_d{d}') for w in W_indices for d in D_indices }
+    works_on_day = { (w,d): model_NewBoolVar(f'works_w{w}_d{d}') for w in W_indices for d in D_indices }
+    # 連続勤務・週勤務日数の窓はスライスで取り出せるように (w,d) の2次元配列でも保持する
+    works_on_day_arr = np.empty((num_employees, num_total_days), dtype=object)
+    for (w, d), works_var in works_on_day.items():
+        works_on_day_arr[w, d] = works_var
     add_log(full_result_ref, 'schedule', f"[{run_id}] 補助変数 (works_on_day) 作成完了", {"num_works_on_day_vars": len(works_on_day)})
 
     # --- 制約設定の記録用 ---
-    current_constraints_settings = {
-        "run_id": run_id,
-        "retry_attempt": retry_attempt,
-        "hard_constraints": [
-            "employee_availability_and_preferred_facility",
-            "employee_one_facility_at_a_time",
-            "works_on_day_definition",
-            "overnight_shift_continuity", # 夜勤連続性
-            "max_weekly_hours_40",        # 週40時間
-            "min_rest_interval_8h",       # 勤務間インターバル
-            "no_facility_change_within_day" # 同日施設変更禁止(近似)
-        ],
-        "soft_constraints_settings": {
-            "consecutive_days": {
-                "base_penalty": settings.get('consecutive_days_penalty', 20000),
-                "multiplier": penalty_multipliers.get("consecutive_days", 1.0)
-            },
-            "weekly_days": {
-                "base_penalty": settings.get('weekly_days_penalty', 10000),
-                "multiplier": penalty_multipliers.get("weekly_days", 1.0)
-            },
-            "daily_hours": {
-                "base_penalty": settings.get('daily_hours_penalty', 30000),
-                "multiplier": penalty_multipliers.get("daily_hours", 1.0)
-            },
-            "staff_shortage": {
-                "base_penalty": settings.get('staff_shortage_penalty', 50000),
-                "multiplier": penalty_multipliers.get("staff_shortage", 1.0),
-                "apply_difficulty_score_to_shortage": True
-            },
-            "difficulty_fairness": {
-                "base_penalty": settings.get('fairness_penalty_weight_difficulty', 1000),
-                "multiplier": penalty_multipliers.get("difficulty_fairness", 1.0)
-            }
-        }
-    }
+    current_constraints_settings = build_constraints_settings(settings, run_id)
 
     if 'applied_constraints_history' not in full_result_ref: 
         full_result_ref['applied_constraints_history'] = [] # HTTP関数の場合、最初に初期化
@@ -373,7 +674,7 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
     #                 # continue # この continue は不要。内側のループで処理が終わる。
     #         for d_idx in D_indices:
     #             for h_idx in H_indices:
-    #                 if not emp_avail_matrix.get((w_idx, d_idx, h_idx), False):
+    #                 if not emp_avail_matrix[w_idx, d_idx, h_idx]:
     #                     model.Add(x[f_idx, w_idx, d_idx, h_idx] == 0)
     
     # 〇 従業員は同時に1つの施設でのみ勤務可能
@@ -397,139 +698,69 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
     # ★ 1. 「1リクエスト(スロット):1施設」制約 (y変数の制約)
     # 各 availability スロットは、最大で1つの施設にのみ割り当てられる
     add_log(full_result_ref, 'schedule', f"[{run_id}] ハード制約: 1リクエスト:1施設 追加")
-    for slot in all_availability_slots:
-        slot_idx = slot['global_slot_idx']
-        assign_vars_for_slot = [v for k, v in y.items() if k[0] == slot_idx]
-        if assign_vars_for_slot:
-            model.Add(sum(assign_vars_for_slot) <= 1)
-
-    # ★ 2. y変数とx変数の連携制約 (重要)
-    # x[f,w,d,h] = 1 <=> (それをカバーするy[slot,f]のどれかが1)
-    add_log(full_result_ref, 'schedule', f"[{run_id}] ハード制約: y変数とx変数の連携 追加")
-    for (f_idx, w_idx, d_idx, h_idx), x_var in x.items():
-        # このx_varに対応する(勤務可能である)y変数をすべて見つける
-        possible_y_vars = []
-        for slot in all_availability_slots:
-            if slot['employee_idx'] == w_idx:
-                # このスロットが(d_idx, h_idx)をカバーするかチェック
-                covers_this_hour = False
-                slot_date = planning_start_date_obj + datetime.timedelta(days=d_idx)
-                if days_of_week_order[slot_date.weekday()] == slot['day_of_week']:
-                    start_h = parse_time_to_int(full_result_ref, slot['start_time'])
-                    end_h = parse_time_to_int(full_result_ref, slot['end_time'])
-                    if slot.get('is_night_shift', False) and end_h < start_h: # 日またぎ
-                        if start_h <= h_idx < 24: covers_this_hour = True
-                    else:
-                        if start_h <= h_idx < end_h: covers_this_hour = True
-                elif slot.get('is_night_shift', False): # 翌日のチェック
-                    prev_slot_date = slot_date - datetime.timedelta(days=1)
-                    if days_of_week_order[prev_slot_date.weekday()] == slot['day_of_week']:
-                        start_h = parse_time_to_int(full_result_ref, slot['start_time'])
-                        end_h = parse_time_to_int(full_result_ref, slot['end_time'])
-                        if end_h < start_h and 0 <= h_idx < end_h: covers_this_hour = True
-                
-                if covers_this_hour:
-                    y_var = y.get((slot['global_slot_idx'], f_idx))
-                    if y_var is not None:
-                        possible_y_vars.append(y_var)
-        
-        # x_var <=> OR(possible_y_vars) の関係を定義
-        if possible_y_vars:
-            # x_varが1なら、yのどれかが1
-            model.Add(sum(possible_y_vars) >= 1).OnlyEnforceIf(x_var)
-            # yのどれかが1なら、x_varは1
-            # (これは、yが1ならxが1という制約を各yについて課すことで実現できる)
-            # このままだと y->x の片方向。双方向にするには以下が必要。
-            # model.Add(sum(possible_y_vars) > 0).OnlyEnforceIf(x_var) と
-            # model.Add(sum(possible_y_vars) == 0).OnlyEnforceIf(x_var.Not())
-            # より直接的なのは AddBoolOr
-            model.Add(x_var == model.NewBoolVar(f'or_y_for_x_{f_idx}_{w_idx}_{d_idx}_{h_idx}'))
-            model.AddBoolOr(possible_y_vars).OnlyEnforceIf(x_var)
-            model.AddImplication(x_var, model.NewBoolVar(f'placeholder_for_or_y_for_x_{f_idx}_{w_idx}_{d_idx}_{h_idx}').Not()) # この方法は複雑
-
-            # ★★★ 最もシンプルで正しい実装 ★★★
-            # x[f,w,d,h] = 1 であることと、それをカバーするy[slot, f]のいずれかが1であることが同値
-            # x[f,w,d,h] <=> OR(y_1, y_2, ...)
-            or_of_y_vars = model.NewBoolVar(f'or_y_{f_idx}_{w_idx}_{d_idx}_{h_idx}')
-            model.AddBoolOr(possible_y_vars).OnlyEnforceIf(or_of_y_vars)
-            model.Add(sum(possible_y_vars) == 0).OnlyEnforceIf(or_of_y_vars.Not())
-            model.Add(x_var == or_of_y_vars)
-        else:
-            # このxをカバーするyが存在しない (通常は発生しないはず)
-            model.Add(x_var == 0)
+    y_by_slot = collections.defaultdict(list) # y を一度の走査でスロットごとに振り分ける
+    for (slot_idx, f_idx), y_var in y.items():
+        y_by_slot[slot_idx].append(y_var)
+    for assign_vars_for_slot in y_by_slot.values():
+        model_Add(LinearExpr_Sum(assign_vars_for_slot) <= 1)
+
+    # ★ 2. y変数とx変数の連携制約
+    # x[f,w,d,h] <=> OR(それをカバーする y[slot,f]) は、x の生成時に (y をそのまま使うか AddBoolOr/AddImplication で) 定義済み
 
     # 〇 従業員がその日に1時間でも働いているか確認
     # 連続勤務日数と週あたり勤務日数の計算
+    # works_on_day[w,d] <=> OR(その日の x) を節 (AddBoolOr / AddImplication) で表現する (整数和の条件付き制約を使わない)
     for w_idx in W_indices:
         for d_idx in D_indices:
-            hours_worked_this_day = sum(x.get((f, w_idx, d_idx, h), 0) for f in F_indices for h in H_indices)
-            model.Add(hours_worked_this_day > 0).OnlyEnforceIf(works_on_day[w_idx, d_idx])
-            model.Add(hours_worked_this_day == 0).OnlyEnforceIf(works_on_day[w_idx, d_idx].Not())
+            works_var = works_on_day[w_idx, d_idx]
+            # 同じ y を複数の時間で共有しているため、リテラルは重複を除いてから使う
+            day_literals = list({x_var.Index(): x_var for x_var in x_by_wd[w_idx, d_idx]}.values())
+            model_AddBoolOr(day_literals + [works_var.Not()])
+            for x_var in day_literals:
+                model_AddImplication(x_var, works_var)
+
+    # 〇 各時間に勤務しているか (週40時間・1日の労働時間・勤務間インターバルで共通に使う)
+    # 全時間スロットを1次元のグローバル時間インデックス (global_h_idx) で扱う
+    total_hours_in_period = num_total_days * HOURS_IN_DAY
+    # works_at_hour[w, global_h]: その時間にいずれかの施設で勤務しているか。(w, global_h) ごとに1つだけ作り、全ての制約で使い回す
+    # 勤務可能なシフトが1つだけの時間はその x をそのまま使い、複数ある時間は sum(x) == works の等式で定義する (同時刻に2施設は不可)
+    # 勤務可能なシフトがない時間はキーを持たない (常に0)
+    works_at_hour = {}
+    works_at_hour_by_wd = collections.defaultdict(list) # (w,d) -> その日の works_at_hour (施設をまたいで1時間1リテラル)
+    for (w_idx, d_idx, h_idx), possible_shifts in x_by_wdh.items():
+        global_h_idx = d_idx * HOURS_IN_DAY + h_idx
+        if len(possible_shifts) == 1:
+            works_var = possible_shifts[0]
+        else:
+            works_var = model_NewBoolVar(f'w_{w_idx}_g{global_h_idx}')
+            model_Add(LinearExpr_Sum(possible_shifts) == works_var)
+        works_at_hour[w_idx, global_h_idx] = works_var
+        works_at_hour_by_wd[w_idx, d_idx].append(works_var)
 
     # 〇 週最大40時間
     MAX_WEEKLY_HOURS = 40
     for w_idx in W_indices:
         # 計画期間全体でチェック（7日を超える場合は、各7日間ブロックでチェック）
         for week_start_day_idx in range(0, num_total_days, 7):
-            hours_in_week_segment = sum(x.get((f, w_idx, d, h), 0)
-                                        for f in F_indices
+            # 1時間に勤務できる施設は1つなので、施設ごとの x ではなく works_at_hour を足せば項数が施設数分の1になる
+            hours_in_week_segment = LinearExpr_Sum([works_var
                                         for d in range(week_start_day_idx, min(week_start_day_idx + 7, num_total_days))
-                                        for h in H_indices)
-            model.Add(hours_in_week_segment <= MAX_WEEKLY_HOURS)
+                                        for works_var in works_at_hour_by_wd.get((w_idx, d), ())])
+            model_Add(hours_in_week_segment <= MAX_WEEKLY_HOURS)
 
     # 〇 勤務間インターバル8時間
     MIN_REST_HOURS = 8
-    # 全時間スロットを1次元で扱う
-    # ロジックを1次元のグローバル時間インデックス (global_h_idx) を使うように整理し、可読性を少し改善
-    total_hours_in_period = num_total_days * HOURS_IN_DAY
-    for w_idx in W_indices:
-        for global_h_idx in range(total_hours_in_period):
-            d_idx = global_h_idx // HOURS_IN_DAY
-            h_idx = global_h_idx % HOURS_IN_DAY
-
-            # この時間(global_h_idx)に勤務しているか
-            works_at_h = model.NewBoolVar(f'w_{w_idx}_g{global_h_idx}')
-            possible_shifts = [x.get((f, w_idx, d_idx, h_idx)) for f in F_indices if x.get((f, w_idx, d_idx, h_idx)) is not None]
-            if possible_shifts:
-                model.Add(sum(possible_shifts) == 1).OnlyEnforceIf(works_at_h)
-                model.Add(sum(possible_shifts) == 0).OnlyEnforceIf(works_at_h.Not())
-            else: # 勤務可能なシフトがなければ常に0
-                model.Add(works_at_h == 0)
-
-            # この時間(global_h_idx)に勤務を終了するかどうか (hに勤務、かつh+1に非勤務)
-            is_end_of_shift_at_h = model.NewBoolVar(f'end_{w_idx}_g{global_h_idx}')
-            if global_h_idx + 1 < total_hours_in_period:
-                next_d_idx = (global_h_idx + 1) // HOURS_IN_DAY
-                next_h_idx = (global_h_idx + 1) % HOURS_IN_DAY
-                works_at_h_plus_1 = model.NewBoolVar(f'w_{w_idx}_g{global_h_idx+1}')
-                possible_shifts_next = [x.get((f, w_idx, next_d_idx, next_h_idx)) for f in F_indices if x.get((f, w_idx, next_d_idx, next_h_idx)) is not None]
-                if possible_shifts_next:
-                    model.Add(sum(possible_shifts_next) == 1).OnlyEnforceIf(works_at_h_plus_1)
-                    model.Add(sum(possible_shifts_next) == 0).OnlyEnforceIf(works_at_h_plus_1.Not())
-                else:
-                    model.Add(works_at_h_plus_1 == 0)
-                
-                model.AddBoolAnd([works_at_h, works_at_h_plus_1.Not()]).OnlyEnforceIf(is_end_of_shift_at_h)
-                model.AddBoolOr([works_at_h.Not(), works_at_h_plus_1]).OnlyEnforceIf(is_end_of_shift_at_h.Not())
-            else: # 計画期間の最後の時間スロット
-                model.Add(is_end_of_shift_at_h == works_at_h)
-
-            # 勤務終了後のインターバルを確保
-            for rest_offset in range(1, MIN_REST_HOURS):
-                rest_global_idx = global_h_idx + rest_offset
-                if rest_global_idx < total_hours_in_period:
-                    rest_d_idx = rest_global_idx // HOURS_IN_DAY
-                    rest_h_idx = rest_global_idx % HOURS_IN_DAY
-                    # この時間帯は勤務不可 (works_at_h の定義から、どの施設でも働けないことになる)
-                    rest_works_var = model.NewBoolVar(f'w_{w_idx}_g{rest_global_idx}')
-                    rest_possible_shifts = [x.get((f, w_idx, rest_d_idx, rest_h_idx)) for f in F_indices if x.get((f, w_idx, rest_d_idx, rest_h_idx)) is not None]
-                    if rest_possible_shifts:
-                        model.Add(sum(rest_possible_shifts) == 1).OnlyEnforceIf(rest_works_var)
-                        model.Add(sum(rest_possible_shifts) == 0).OnlyEnforceIf(rest_works_var.Not())
-                    else:
-                        model.Add(rest_works_var == 0)
-
-                    model.Add(rest_works_var == 0).OnlyEnforceIf(is_end_of_shift_at_h)
+    # h に勤務し h+1 に勤務していない (= h で勤務終了) なら、h+2 .. h+MIN_REST_HOURS-1 は勤務不可
+    # 終了を表す補助変数は作らず、3リテラルの節 (NOT works[h] OR works[h+1] OR NOT works[h+k]) で直接表現する
+    for (w_idx, global_h_idx), works_var in works_at_hour.items():
+        if global_h_idx + 1 >= total_hours_in_period: # 計画期間の最後の時間スロット (以降に休息を確保する時間がない)
+            continue
+        works_next_var = works_at_hour.get((w_idx, global_h_idx + 1))
+        end_of_shift_literals = [works_var.Not()] if works_next_var is None else [works_var.Not(), works_next_var]
+        for rest_global_idx in range(global_h_idx + 2, min(global_h_idx + MIN_REST_HOURS, total_hours_in_period)):
+            rest_works_var = works_at_hour.get((w_idx, rest_global_idx))
+            if rest_works_var is not None:
+                model_AddBoolOr(end_of_shift_literals + [rest_works_var.Not()])
 
     # 〇 夜勤シフトの連続性保証 (日付またぎ)
     # 例えば、22時または23時に勤務開始し、それが夜勤とみなされるパターンを定義
@@ -703,74 +934,68 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
 
     # --- ソフト制約 ---
 
-    # 緩和対象のペナルティを明確に区別
-    soft_penalty_terms = []
-    objective_terms = []
+    # ソフト制約のペナルティ項は変数と係数 (整数化したベースペナルティ) の並列リストで持ち、目的関数の設定時に直接コスト項と合わせる
+    soft_constraints_settings = current_constraints_settings["soft_constraints_settings"]
+    soft_penalty_coeffs = {penalty_name: int(round(penalty_settings["base_penalty"])) for penalty_name, penalty_settings in soft_constraints_settings.items()}
+    penalty_vars = []
+    penalty_coeffs = []
+    # 目的関数の直接コスト項は変数と係数の並列リストで持ち、最後に WeightedSum で一括して式にする
+    objective_vars = []
+    objective_coeffs = []
 
-    # スケールファクタを定義
-    # ここでは、浮動小数点数スコア（コスト）を1000倍して整数として扱う        
-    SCALE_FACTOR = 1000 # 1000なら小数点数3位までのコスト精度を確保
-    
     # 〇 最大連続勤務日数 (ソフト制約)
     max_consecutive_setting = settings.get('max_consecutive_work_days', 5)
-    base_consecutive_penalty = current_constraints_settings["soft_constraints_settings"]["consecutive_days"]["base_penalty"]
-    current_consecutive_multiplier = current_constraints_settings["soft_constraints_settings"]["consecutive_days"]["multiplier"]
-    effective_consecutive_penalty = int(round(base_consecutive_penalty * current_consecutive_multiplier)) # 整数化
 
     if max_consecutive_setting > 0 and num_total_days > max_consecutive_setting:
+        # (max_consecutive_setting + 1) 日の窓を全従業員分まとめて切り出す (形状: W × 窓の数 × 窓の長さ)
+        consecutive_windows = np.lib.stride_tricks.sliding_window_view(works_on_day_arr, max_consecutive_setting + 1, axis=1)
         for w_idx in W_indices:
-            for d_idx_start in range(num_total_days - max_consecutive_setting):
-                consecutive_days_worked = sum(works_on_day[w_idx, d] for d in range(d_idx_start, d_idx_start + max_consecutive_setting + 1))
-                excess_consecutive = model.NewIntVar(0, max_consecutive_setting + 2, f'ex_consec_w{w_idx}_d{d_idx_start}')
-                
-                is_exceeding = model.NewBoolVar(f'is_ex_consec_w{w_idx}_d{d_idx_start}')
-                model.Add(consecutive_days_worked > max_consecutive_setting).OnlyEnforceIf(is_exceeding)
-                model.Add(consecutive_days_worked <= max_consecutive_setting).OnlyEnforceIf(is_exceeding.Not())
-                model.Add(excess_consecutive == consecutive_days_worked - max_consecutive_setting).OnlyEnforceIf(is_exceeding)
-                model.Add(excess_consecutive == 0).OnlyEnforceIf(is_exceeding.Not())
-                soft_penalty_terms.append(excess_consecutive * effective_consecutive_penalty)
+            consecutive_days_worked_exprs = [LinearExpr_Sum(window) for window in consecutive_windows[w_idx].tolist()]
+            for d_idx_start, consecutive_days_worked in enumerate(consecutive_days_worked_exprs):
+                # 窓の長さは上限+1日なので、超過は最大でも1日
+                excess_consecutive = model_NewIntVar(0, 1, f'ex_consec_w{w_idx}_d{d_idx_start}')
 
-    # 〇 週あたりの最大労働日数 (ソフト制約)
-    base_weekly_days_penalty = current_constraints_settings["soft_constraints_settings"]["weekly_days"]["base_penalty"]
-    current_weekly_days_multiplier = current_constraints_settings["soft_constraints_settings"]["weekly_days"]["multiplier"]
-    effective_weekly_days_penalty = int(round(base_weekly_days_penalty * current_weekly_days_multiplier))
+                # excess = max(0, 連続勤務日数 - 上限) を AddMaxEquality で直接表現 (指示変数・条件付き制約・差分用の補助変数を使わない)
+                model_AddMaxEquality(excess_consecutive, [consecutive_days_worked - max_consecutive_setting, 0])
+                penalty_vars.append(excess_consecutive)
+                penalty_coeffs.append(soft_penalty_coeffs["consecutive_days"])
 
-    for w_idx in W_indices:
-        max_days_week = employees_data[w_idx].get('contract_max_days_per_week', 7)
+    # 〇 週あたりの最大労働日数 (ソフト制約)
+    for w_idx, max_days_week in enumerate(max_days_week_arr.tolist()):
         for week_start_day_idx in range(0, num_total_days, 7):
-            days_in_week = sum(works_on_day[w_idx, d_idx] for d_idx in range(week_start_day_idx, min(week_start_day_idx + 7, num_total_days)))
-            excess_weekly_days = model.NewIntVar(0, 8, f'ex_week_w{w_idx}_wk{week_start_day_idx}')
-            
-            is_exceeding = model.NewBoolVar(f'is_ex_week_w{w_idx}_wk{week_start_day_idx}')
-            model.Add(days_in_week > max_days_week).OnlyEnforceIf(is_exceeding)
-            model.Add(days_in_week <= max_days_week).OnlyEnforceIf(is_exceeding.Not())
-            model.Add(excess_weekly_days == days_in_week - max_days_week).OnlyEnforceIf(is_exceeding)
-            model.Add(excess_weekly_days == 0).OnlyEnforceIf(is_exceeding.Not())
-            soft_penalty_terms.append(excess_weekly_days * effective_weekly_days_penalty)
+            week_works_vars = works_on_day_arr[w_idx, week_start_day_idx:week_start_day_idx + 7].tolist()
+            days_in_week = LinearExpr_Sum(week_works_vars)
+            # 定義域は実際に取りうる超過日数 (週の日数 - 上限) までに絞り、LP緩和を強くする
+            excess_weekly_days = model_NewIntVar(0, max(0, len(week_works_vars) - max_days_week), f'ex_week_w{w_idx}_wk{week_start_day_idx}')
+            model_AddMaxEquality(excess_weekly_days, [days_in_week - max_days_week, 0])
+            penalty_vars.append(excess_weekly_days)
+            penalty_coeffs.append(soft_penalty_coeffs["weekly_days"])
 
     # 〇 1日あたりの最大労働時間 (ソフト制約)
-    base_daily_hours_penalty = current_constraints_settings["soft_constraints_settings"]["daily_hours"]["base_penalty"]
-    current_daily_hours_multiplier = current_constraints_settings["soft_constraints_settings"]["daily_hours"]["multiplier"]
-    effective_daily_hours_penalty = int(round(base_daily_hours_penalty * current_daily_hours_multiplier))
-
-    for w_idx in W_indices:
-        max_hours_day = employees_data[w_idx].get('contract_max_hours_per_day', HOURS_IN_DAY)
+    for w_idx, max_hours_day in enumerate(max_hours_day_arr.tolist()):
         for d_idx in D_indices:
 
-            hours_worked = sum(x.get((f_idx, w_idx, d_idx, h_idx), 0) for f_idx in F_indices for h_idx in H_indices)
-            excess_daily_hours = model.NewIntVar(0, HOURS_IN_DAY + 1, f'ex_day_w{w_idx}_d{d_idx}')
-            
-            is_exceeding = model.NewBoolVar(f'is_ex_day_w{w_idx}_d{d_idx}')
-            model.Add(hours_worked > max_hours_day).OnlyEnforceIf(is_exceeding)
-            model.Add(hours_worked <= max_hours_day).OnlyEnforceIf(is_exceeding.Not())
-            model.Add(excess_daily_hours == hours_worked - max_hours_day).OnlyEnforceIf(is_exceeding)
-            model.Add(excess_daily_hours == 0).OnlyEnforceIf(is_exceeding.Not())
-            soft_penalty_terms.append(excess_daily_hours * effective_daily_hours_penalty)
+            day_works_vars = works_at_hour_by_wd.get((w_idx, d_idx), ())
+            hours_worked = LinearExpr_Sum(day_works_vars)
+            # 超過時間はその日の勤務可能時間数 - 上限 を超えない (勤務可能時間の少ない日ほど定義域が狭くなる)
+            excess_daily_hours = model_NewIntVar(0, max(0, len(day_works_vars) - max_hours_day), f'ex_day_w{w_idx}_d{d_idx}')
+            model_AddMaxEquality(excess_daily_hours, [hours_worked - max_hours_day, 0])
+            penalty_vars.append(excess_daily_hours)
+            penalty_coeffs.append(soft_penalty_coeffs["daily_hours"])
 
     # 〇 各日の必要人数の充足 (ソフト制約)
-    base_staff_shortage_penalty_config = current_constraints_settings["soft_constraints_settings"]["staff_shortage"]["base_penalty"]
-    current_staff_shortage_global_multiplier = current_constraints_settings["soft_constraints_settings"]["staff_shortage"]["multiplier"]
-    apply_difficulty_to_shortage = current_constraints_settings["soft_constraints_settings"]["staff_shortage"]["apply_difficulty_score_to_shortage"]
+    base_staff_shortage_penalty_config = soft_constraints_settings["staff_shortage"]["base_penalty"]
+
+    # 必要人数と不足1人あたりのペナルティを (f,d,h) の配列として制約追加前に一括計算しておく
+    facility_shortage_penalty_arr = np.zeros(num_facilities, dtype=np.float64) # 施設ごとのベースペナルティ
+    facility_cleaning_capacity_arr = np.ones(num_facilities, dtype=np.float64)
+
+    # 清掃タスク数は (f,d) にのみ依存するため、ここで (F,D) の表として一度だけ取得する
+    # (時間ごとの必要人数・結果整形時の不足人数レポートはこの表から計算した required_staff_arr を共有する)
+    cleaning_tasks_arr = np.array([
+        [get_cleaning_tasks_for_day_facility(full_result_ref, facility_idx_to_id[f_idx], current_date, cleaning_tasks_data, days_of_week_order) for current_date in planning_dates]
+        for f_idx in F_indices
+    ], dtype=np.float64).reshape(num_facilities, num_total_days)
 
     for f_idx in F_indices:
 
@@ -783,50 +1008,34 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
         if facility_shortage_override_multiplier is not None:
              base_shortage_penalty_for_facility *= facility_shortage_override_multiplier
         
-        effective_base_penalty_for_facility = base_shortage_penalty_for_facility * current_staff_shortage_global_multiplier
+        facility_shortage_penalty_arr[f_idx] = base_shortage_penalty_for_facility
 
         facility_cleaning_capacity_per_hr = facility_details.get('cleaning_capacity_tasks_per_hour_per_employee', 1)
         if facility_cleaning_capacity_per_hr <= 0: facility_cleaning_capacity_per_hr = 1
-
-        for d_idx in D_indices:
-            current_date = planning_start_date_obj + datetime.timedelta(days=d_idx)
-            daily_cleaning_tasks = get_cleaning_tasks_for_day_facility(full_result_ref, facility_idx_to_id[f_idx], current_date, cleaning_tasks_data, days_of_week_order)
-            
-            for h_idx in H_indices:
-                required_staff_target = 1
-                if cleaning_start_h <= h_idx < cleaning_end_h:
-                    if cleaning_hours_duration > 0 and daily_cleaning_tasks > 0:
-                        required_staff_target = max(1, math.ceil(daily_cleaning_tasks / (facility_cleaning_capacity_per_hr * cleaning_hours_duration)))
-                
-                # 疎な変数生成に対応
-                staff_count = sum(x.get((f_idx, w_idx, d_idx, h_idx), 0) for w_idx in W_indices)
-                actual_shortage = model.NewIntVar(0, max(1, num_employees), f'sh_f{f_idx}_d{d_idx}_h{h_idx}')
-
-                # 不足人数を計算 (>= 0)
-                model.Add(actual_shortage >= required_staff_target - staff_count)
-
-                penalty_value_for_this_slot = effective_base_penalty_for_facility
-
-                # ★コンテキストによる難易度スコアの精緻化
-                # 元々の時間帯・曜日の難易度スコアを取得
-                base_shift_difficulty_score = difficulty_score_map.get((f_idx, d_idx, h_idx), base_score_ph)
-                
-                # コンテキストに応じた追加乗数
-                context_multiplier = 1.0
-                # 清掃シフト時間帯以外の不足はより重大と見なす（常駐義務違反）
-                if cleaning_start_h >= h_idx > cleaning_end_h:
-                    context_multiplier *= settings.get("cleaning_shift_shortage_multiplier", 1.5) # 例: 1.5倍のペナルティ
-                # 他の重要なコンテキスト（例: イベント日など）もここに追加可能
-
-                # 最終的な難易度スコアを計算
-                final_shift_difficulty_score = base_shift_difficulty_score * context_multiplier
-                
-                if apply_difficulty_to_shortage:
-                    penalty_value_for_this_slot *= final_shift_difficulty_score
-                
-                # スケーリングを適用して整数化
-                final_penalty_per_short_person = int(round(penalty_value_for_this_slot * SCALE_FACTOR))
-                soft_penalty_terms.append(actual_shortage * final_penalty_per_short_person)
+        facility_cleaning_capacity_arr[f_idx] = facility_cleaning_capacity_per_hr
+
+    cleaning_shift_shortage_multiplier = settings.get("cleaning_shift_shortage_multiplier", 1.5) # 例: 1.5倍のペナルティ
+    required_staff_arr, shortage_penalty_arr = prepare_shortage_penalties(
+        difficulty_score_arr, cleaning_tasks_arr, facility_cleaning_capacity_arr, facility_shortage_penalty_arr,
+        cleaning_start_h, cleaning_end_h, cleaning_shift_shortage_multiplier,
+        soft_constraints_settings["staff_shortage"]["apply_difficulty_score_to_shortage"], SCALE_FACTOR
+    )
+
+    # 必要人数が1以上の枠だけを (f,d,h) の順に1次元で列挙し、単一のループで制約を追加する
+    shortage_slots = np.argwhere(required_staff_arr > 0)
+    shortage_flat_idx = np.ravel_multi_index(shortage_slots.T, required_staff_arr.shape)
+    shortage_upper_bound = max(1, num_employees)
+    penalty_coeffs.extend(shortage_penalty_arr.ravel()[shortage_flat_idx].tolist()) # 下のループで追加する不足変数と同じ並び
+    for (f_idx, d_idx, h_idx), required_staff_target in zip(shortage_slots.tolist(), required_staff_arr.ravel()[shortage_flat_idx].tolist()):
+        # 疎な変数生成に対応
+        staff_count = LinearExpr_Sum(x_by_fdh[f_idx, d_idx, h_idx])
+        # 不足の上限は従来どおり従業員数 (最低1) とする。必要人数が従業員数を超える枠では、これにより (必要人数 - 従業員数) 名以上の配置が必須になる
+        # (最適解の不足は必要人数を超えないため、必要人数でも上限を絞ってよい)
+        actual_shortage = model_NewIntVar(0, min(required_staff_target, shortage_upper_bound), f'sh_f{f_idx}_d{d_idx}_h{h_idx}')
+
+        # 不足人数を計算 (>= 0)
+        model_Add(actual_shortage >= required_staff_target - staff_count)
+        penalty_vars.append(actual_shortage)
 
     # 〇 施設移動に対するペナルティ (ソフト制約)
     # SPECIAL_MOVE_START_HOUR = 10
@@ -874,188 +1083,190 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
     #                         soft_penalty_terms.append(move_event * facility_move_base_penalty)
 
 
+    # ★ 公平性制約の従業員別の項と、目的関数の難易度コスト項を x の1回の走査でまとめて作る
+    # (従業員ごとに x 全体を走査し直すと W×|x| になるため)
+    # 目的関数の係数は (f,d,h) ごとに配列で一括計算し、ループ内では参照のみ行う
+    global_diff_multiplier = settings.get("global_difficulty_cost_multiplier", 0.1)
+    objective_coeff_arr = np.round(difficulty_score_arr * global_diff_multiplier).astype(np.int64)
+    difficulty_score_list = difficulty_score_arr.tolist() # スカラー参照はネストしたリストの方が速い
+    objective_coeff_list = objective_coeff_arr.tolist()
+    vars_scaled_per_employee = [[] for _ in W_indices]
+    coeffs_scaled_per_employee = [[] for _ in W_indices]
+    for (f, w, d, h), var in x.items(): # 変数が存在する組み合わせのみループ
+        vars_scaled_per_employee[w].append(var)
+        coeffs_scaled_per_employee[w].append(difficulty_score_list[f][d][h]) # スコアはスケーリング済み
+        objective_vars.append(var)
+        objective_coeffs.append(objective_coeff_list[f][d][h])
+
     # 〇 従業員間の総獲得難易度スコアの公平性 (ソフト制約)
     total_difficulty_per_employee_vars = []
-    max_possible_difficulty_score = int(HOURS_IN_DAY * 7 * max(weekend_multi, night_multi, 1) * SCALE_FACTOR * 2) # 余裕を持った上限値
+    # 上限は各従業員が入りうる全スロットの難易度スコア合計 (実際に到達可能な値) にして定義域を絞る
+    max_difficulty_per_employee = [sum(coeffs) for coeffs in coeffs_scaled_per_employee]
+    max_possible_difficulty_score = max(max_difficulty_per_employee, default=0)
     
     for w_idx in W_indices:
-        employee_total_difficulty_scaled = model.NewIntVar(0, max_possible_difficulty_score, f'total_diff_s_w{w_idx}')
+        employee_total_difficulty_scaled = model_NewIntVar(0, max_difficulty_per_employee[w_idx], f'total_diff_s_w{w_idx}')
         
         # ★ 疎な変数生成に対応
-        terms_scaled = []
-        for (f, w, d, h), var in x.items(): # 変数が存在する組み合わせのみループ
-            if w == w_idx:
-                scaled_score = int(round(difficulty_score_map.get((f, d, h), base_score_ph) * SCALE_FACTOR))
-                terms_scaled.append(var * scaled_score)
+        vars_scaled = vars_scaled_per_employee[w_idx]
+        coeffs_scaled = coeffs_scaled_per_employee[w_idx]
         
-        if terms_scaled:
-            model.Add(employee_total_difficulty_scaled == sum(terms_scaled))
+        if vars_scaled:
+            model_Add(employee_total_difficulty_scaled == cp_model.LinearExpr.WeightedSum(vars_scaled, coeffs_scaled))
         else: # この従業員が働けるスロットが一つもない場合
-            model.Add(employee_total_difficulty_scaled == 0)
+            model_Add(employee_total_difficulty_scaled == 0)
             
         total_difficulty_per_employee_vars.append(employee_total_difficulty_scaled)
     
     if total_difficulty_per_employee_vars:
-        max_total_difficulty_var_s = model.NewIntVar(0, max_possible_difficulty_score, 'max_total_diff_s')
-        min_total_difficulty_var_s = model.NewIntVar(0, max_possible_difficulty_score, 'min_total_diff_s')
+        max_total_difficulty_var_s = model_NewIntVar(0, max_possible_difficulty_score, 'max_total_diff_s')
+        min_total_difficulty_var_s = model_NewIntVar(0, max_possible_difficulty_score, 'min_total_diff_s')
         model.AddMaxEquality(max_total_difficulty_var_s, total_difficulty_per_employee_vars)
         model.AddMinEquality(min_total_difficulty_var_s, total_difficulty_per_employee_vars)
         
-        difficulty_spread_penalty_var_s = model.NewIntVar(0, max_possible_difficulty_score, 'diff_spread_pen_s')
-        model.Add(difficulty_spread_penalty_var_s == max_total_difficulty_var_s - min_total_difficulty_var_s)
-        
-        base_fairness_penalty = current_constraints_settings["soft_constraints_settings"]["difficulty_fairness"]["base_penalty"]
-        current_fairness_multiplier = current_constraints_settings["soft_constraints_settings"]["difficulty_fairness"]["multiplier"]
-        
+        difficulty_spread_penalty_var_s = model_NewIntVar(0, max_possible_difficulty_score, 'diff_spread_pen_s')
+        model_Add(difficulty_spread_penalty_var_s == max_total_difficulty_var_s - min_total_difficulty_var_s)
         # ★ 公平性ペナルティの重み自体はスケーリングしない。差分がスケーリングされているため。
-        effective_fairness_penalty_weight = int(round(base_fairness_penalty * current_fairness_multiplier))
-        soft_penalty_terms.append(difficulty_spread_penalty_var_s * effective_fairness_penalty_weight)
+        penalty_vars.append(difficulty_spread_penalty_var_s)
+        penalty_coeffs.append(soft_penalty_coeffs["difficulty_fairness"])
+
+    # 〇 貪欲法による初期解をヒントとして与える (LNSが最初の実行可能解から探索を始められるように)
+    # ワーカー数が少ない環境ではヒント周辺に探索が偏り、かえって最終的な目的関数値が悪化することがあるため既定では無効
+    use_greedy_hint = settings.get('use_greedy_hint', False)
+    if use_greedy_hint:
+        hint_slot_assignment = build_greedy_hint(slots_covered_hours, slots_employee_idx, slots_target_facilities, required_staff_arr, num_employees, MAX_WEEKLY_HOURS, MIN_REST_HOURS)
+
+        hinted_x_keys = set()
+        for slot_idx, f_idx in hint_slot_assignment.items():
+            w_idx = slots_employee_idx[slot_idx]
+            hinted_x_keys.update((f_idx, w_idx, d_idx, h_idx) for d_idx, h_idx in slots_covered_hours[slot_idx])
+        for (slot_idx, f_idx), y_var in y.items():
+            model.AddHint(y_var, hint_slot_assignment.get(slot_idx) == f_idx)
+        y_var_indices = {y_var.Index() for y_var in y.values()}
+        for key, x_var in x.items():
+            if x_var.Index() not in y_var_indices: # y をそのまま使っている x は y のヒントで設定済み (同じ変数への重複ヒントは不可)
+                model.AddHint(x_var, key in hinted_x_keys)
+        hinted_working_days = {(w_idx, d_idx) for _, w_idx, d_idx, _ in hinted_x_keys}
+        for key, works_var in works_on_day.items():
+            model.AddHint(works_var, key in hinted_working_days)
+        add_log(full_result_ref, 'schedule', f"[{run_id}] 貪欲法による初期解ヒント設定完了", {"num_hinted_slots": len(hint_slot_assignment)})
 
-    # 〇 目的関数（シフトが実際に組まれた場合に直接的に発生するコストや評価）
-    # objective_terms と soft_penalty_terms を分けておく方が、緩和対象のペナルティを明確に区別でき、シンプルロジックを維持できる
-    global_diff_multiplier = settings.get("global_difficulty_cost_multiplier", 0.1)
+    solver = cp_model.CpSolver()
+    # 探索ログは標準出力に流さず (Cloud Run ではログ転送が同期的に発生するため)、有効時のみ末尾をリングバッファに保持して結果ログに残す
+    verbose_solver_log = settings.get('verbose_solver_log', False)
+    solver_log_lines = collections.deque(maxlen=SOLVER_LOG_MAX_LINES)
+    if verbose_solver_log:
+        solver.parameters.log_search_progress = True
+        solver.parameters.log_to_stdout = False
+        solver.log_callback = solver_log_lines.append
+    # Cloud Run環境でのリソース制限を考慮 (settings.num_workers で上書き可能。ただしインスタンスの CPU 数を超えるワーカーは作らない)
+    MAX_WORKERS = min(8, os.cpu_count() or 1)  # より安全な実装例
+    solver.parameters.num_workers = min(settings.get('num_workers') or MAX_WORKERS, os.cpu_count() or 1) # num_search_workers は旧名称
+    # 再現性が必要な場合 (テスト等) は乱数シードを固定し、並列探索の結果もワーカーの実行順に依存しないようにする
+    if settings.get('random_seed') is not None:
+        solver.parameters.random_seed = settings['random_seed']
+    if settings.get('deterministic_search', False):
+        solver.parameters.interleave_search = True
+    # コア最小化と LP 緩和の強さは CP-SAT の既定値のままとし、settings で指定された場合だけ変更する (入力ごとに効果を比較できるように)
+    # (値の範囲は入力検証 (SOLVER_INT_SETTING_RANGES) で確認済み)
+    if settings.get('core_minimization_level') is not None:
+        solver.parameters.core_minimization_level = settings['core_minimization_level']
+    if settings.get('linearization_level') is not None:
+        solver.parameters.linearization_level = settings['linearization_level']
+    # 貪欲法のヒントを与えた場合は、ヒントが実行不可能でもそこから修復して探索を始める
+    if use_greedy_hint:
+        solver.parameters.repair_hint = True
 
-    for (f, w, d, h), var in x.items():
-        difficulty_cost_float = difficulty_score_map.get((f, d, h), base_score_ph)
-        # スケーリングを適用
-        additional_difficulty_cost_scaled = int(round(difficulty_cost_float * global_diff_multiplier * SCALE_FACTOR))
-        objective_terms.append(var * additional_difficulty_cost_scaled)
-    
+    # 〇 目的関数（シフトが実際に組まれた場合に直接的に発生するコストや評価）
+    # (難易度コスト項 objective_* は公平性制約と同じ走査で、ペナルティ項 penalty_* は各ソフト制約の追加時に作成済み)
     # 直接的なコストと、制約違反のペナルティの合計を最小化する
-    model.Minimize(sum(objective_terms) + sum(soft_penalty_terms))
+    model.Minimize(cp_model.LinearExpr.WeightedSum(objective_vars + penalty_vars, objective_coeffs + penalty_coeffs))
 
     add_log(full_result_ref, 'schedule', f"[{run_id}] 目的関数設定完了")
     add_model_stats_log(full_result_ref, model, 'schedule', f"[{run_id}] 目的関数設定後のモデル状態")
-    
-    solver = cp_model.CpSolver()
-    solver.parameters.max_time_in_seconds = settings.get('time_limit_sec', 60)
-    solver.parameters.log_search_progress = True
-    # Cloud Run環境でのリソース制限を考慮
-    MAX_WORKERS = min(8, os.cpu_count() or 1)  # より安全な実装例
-    solver.parameters.num_search_workers = MAX_WORKERS
 
-    add_log(full_result_ref, 'info', f"[{run_id}] CP-SATソルバー実行開始 (制限時間: {time_limit_sec}秒)")
+    solver.parameters.max_time_in_seconds = float(time_limit_sec)
+    add_log(full_result_ref, 'info', f"[{run_id}] CP-SATソルバー実行開始 (制限時間: {solver.parameters.max_time_in_seconds:.1f}秒)")
     status = solver.Solve(model)
     status_str = CP_SOLVER_STATUS_MAP.get(status, 'UNKNOWN')
     objective_value = solver.ObjectiveValue() if status in [cp_model.OPTIMAL, cp_model.FEASIBLE] else None
     wall_time = solver.WallTime()
     add_log(full_result_ref, 'info', f"[{run_id}] CP-SATソルバー実行完了", {'status': status_str, 'wall_time': wall_time, 'objective': objective_value})
+    if verbose_solver_log:
+        add_log(full_result_ref, 'info', f"[{run_id}] CP-SATソルバーログ (末尾{SOLVER_LOG_MAX_LINES}行)", {'solver_log': list(solver_log_lines)})
 
     result = {'status': status_str, 'run_id': run_id, 'applied_constraints_settings': current_constraints_settings}
-    
+
     if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
         result['objective'] = objective_value
         result['wall_time_sec'] = wall_time
         add_log(full_result_ref, 'schedule', f"[{run_id}] 解が見つかりました", {"objective": result['objective'], "wall_time_sec": result['wall_time_sec']})
         
         # アサイン情報に難易度スコアも追加
-        assignments_with_difficulty = [] 
-        for w_idx in W_indices:
-            emp_id = employee_idx_to_id[w_idx]
-            for d_idx in D_indices:
-                current_date_str = (planning_start_date_obj + datetime.timedelta(days=d_idx)).strftime("%Y-%m-%d")                
-                for f_idx in F_indices:
-                    facility_id = facility_idx_to_id[f_idx]
-                    current_block_start_hour = -1
-                    current_block_difficulty_scores = [] 
-
-                    for h_idx in H_indices:
-                        var = x.get((f_idx, w_idx, d_idx, h_idx))
-                        if var is not None and solver.Value(var) == 1:
-                            if current_block_start_hour == -1:
-                                current_block_start_hour = h_idx
-                            current_block_difficulty_scores.append(difficulty_score_map.get((f_idx, d_idx, h_idx), 0))
-                        else:
-                            if current_block_start_hour != -1:
-                                # 平均スコアを計算
-                                total_difficulty = sum(current_block_difficulty_scores)
-                                avg_difficulty = total_difficulty / len(current_block_difficulty_scores) if current_block_difficulty_scores else 0
-                                assignments_with_difficulty.append({
-                                    "employee_id": emp_id,
-                                    "facility_id": facility_id,
-                                    "date": current_date_str,
-                                    "start_hour": current_block_start_hour,
-                                    "end_hour": h_idx,
-                                    "difficulty_score_avg": round(avg_difficulty, 2),
-                                })
-                                current_block_start_hour = -1
-                                current_block_difficulty_scores = []
-
-                    if current_block_start_hour != -1:
-                        total_difficulty = sum(current_block_difficulty_scores)
-                        avg_difficulty = total_difficulty / len(current_block_difficulty_scores) if current_block_difficulty_scores else 0
-                        assignments_with_difficulty.append({
-                            "employee_id": emp_id,
-                            "facility_id": facility_id,
-                            "date": current_date_str,
-                            "start_hour": current_block_start_hour,
-                            "end_hour": HOURS_IN_DAY,
-                            "difficulty_score_avg": round(avg_difficulty, 2),
-                        })
-                        
+        # 解の値を (f,w,d,h) のブール配列に展開し、時間軸方向の差分で連続勤務ブロックの開始・終了を一括検出する
+        # 値の取得は変数ごとの solver.Value ではなく一括取得で行う
+        assigned = np.zeros((num_facilities, num_employees, num_total_days, HOURS_IN_DAY), dtype=np.int8)
+        if x:
+            x_values = get_boolean_values(solver, list(x.values()))
+            x_keys_arr = np.array(list(x.keys()), dtype=np.intp)
+            assigned[tuple(x_keys_arr[x_values].T)] = 1
+        # 出力順 (従業員→日→施設) に合わせて軸を並べ替え、両端を0で埋めて差分を取る
+        padded = np.zeros((num_employees, num_total_days, num_facilities, HOURS_IN_DAY + 2), dtype=np.int8)
+        padded[..., 1:-1] = assigned.transpose(1, 2, 0, 3)
+        edges = np.diff(padded, axis=-1)
+        block_w, block_d, block_f, block_start = np.nonzero(edges == 1)
+        block_end = np.nonzero(edges == -1)[3] # 同じ行の中で開始と終了は必ず対になって現れる
+        # 難易度スコアの累積和からブロックごとの合計を求める
+        difficulty_cumsum = np.zeros((num_facilities, num_total_days, HOURS_IN_DAY + 1), dtype=np.int64)
+        difficulty_cumsum[..., 1:] = np.cumsum(difficulty_score_arr, axis=-1)
+        block_difficulty_avg = (difficulty_cumsum[block_f, block_d, block_end] - difficulty_cumsum[block_f, block_d, block_start]) / (block_end - block_start) / SCALE_FACTOR
+
+        date_str_per_day = [current_date.isoformat() for current_date in planning_dates] # "%Y-%m-%d" 形式
+        assignments_with_difficulty = [
+            {
+                "employee_id": employee_idx_to_id[w_idx],
+                "facility_id": facility_idx_to_id[f_idx],
+                "date": date_str_per_day[d_idx],
+                "start_hour": start_h,
+                "end_hour": end_h,
+                "difficulty_score_avg": round(avg_difficulty, 2),
+            }
+            for w_idx, d_idx, f_idx, start_h, end_h, avg_difficulty in zip(
+                block_w.tolist(), block_d.tolist(), block_f.tolist(), block_start.tolist(), block_end.tolist(), block_difficulty_avg.tolist()
+            )
+        ]
+
         result['assignments'] = assignments_with_difficulty
 
         # 不足シフトとその難易度スコアを記録
-        shortage_shifts_with_difficulty = []
-        for f_idx in F_indices:
-            facility_id = facility_idx_to_id[f_idx]
-            facility_details = facilities_data[f_idx] # staff_shortageペナルティ計算と同様のロジック
-            facility_cleaning_capacity_per_hr = facility_details.get('cleaning_capacity_tasks_per_hour_per_employee', 1)
-            if facility_cleaning_capacity_per_hr <= 0: facility_cleaning_capacity_per_hr = 1
-
-            for d_idx in D_indices:
-                current_date_obj = planning_start_date_obj + datetime.timedelta(days=d_idx)
-                date_str = current_date_obj.strftime("%Y-%m-%d")
-                daily_cleaning_tasks = get_cleaning_tasks_for_day_facility(full_result_ref, facility_id, current_date_obj, cleaning_tasks_data, days_of_week_order)
-                
-                for h_idx in H_indices:
-                    required_staff_target = 1
-                    if cleaning_start_h <= h_idx < cleaning_end_h:
-                        if cleaning_hours_duration > 0 and daily_cleaning_tasks > 0:
-                            required_staff_target = max(1, math.ceil(daily_cleaning_tasks / (facility_cleaning_capacity_per_hr * cleaning_hours_duration)))
-                        else: required_staff_target = 1
-                    
-                    current_assigned_staff = 0
-                    for w_idx_check in W_indices: # この時間、この施設にアサインされた人数を再計算
-                        var_check = x.get((f_idx, w_idx_check, d_idx, h_idx))
-                        if var_check is not None and solver.Value(var_check) == 1:
-                            current_assigned_staff += 1
-                    
-                    actual_shortage_count = required_staff_target - current_assigned_staff
-                    
-                    if actual_shortage_count > 0:
-                        shift_difficulty = difficulty_score_map.get((f_idx, d_idx, h_idx), 0)
-                        shortage_shifts_with_difficulty.append({
-                            "facility_id": facility_id,
-                            "date": date_str,
-                            "hour": h_idx,
-                            "shortage_count": actual_shortage_count,
-                            "required_staff": required_staff_target,
-                            "assigned_staff": current_assigned_staff,
-                            "difficulty_score_of_short_shift": round(shift_difficulty, 2)
-                        })
+        # 必要人数はモデル構築時の required_staff_arr を再利用し、実人数はアサイン配列から一括集計する
+        staff_count_arr = assigned.sum(axis=1, dtype=np.int32) # (f,d,h) ごとのアサイン人数
+        shortage_count_arr = required_staff_arr - staff_count_arr
+        shortage_shifts_with_difficulty = [
+            {
+                "facility_id": facility_idx_to_id[f_idx],
+                "date": date_str_per_day[d_idx],
+                "hour": h_idx,
+                "shortage_count": int(shortage_count_arr[f_idx, d_idx, h_idx]),
+                "required_staff": int(required_staff_arr[f_idx, d_idx, h_idx]),
+                "assigned_staff": int(staff_count_arr[f_idx, d_idx, h_idx]),
+                "difficulty_score_of_short_shift": round(difficulty_score_list[f_idx][d_idx][h_idx] / SCALE_FACTOR, 2)
+            }
+            for f_idx, d_idx, h_idx in zip(*(idx.tolist() for idx in np.nonzero(shortage_count_arr > 0)))
+        ]
 
         result['shortage_shifts_details'] = shortage_shifts_with_difficulty
 
-        # 各従業員の情報を保持する辞書を事前に初期化
-        hours_per_employee = {emp_id: 0 for emp_id in employee_idx_to_id.values()}
-        difficulty_per_employee = {emp_id: 0 for emp_id in employee_idx_to_id.values()}
-
-        # 存在する変数 (x.items()) を一度だけループする効率的な方法
-        for (f, w, d, h), var in x.items():
-            if solver.Value(var) == 1:
-                emp_id = employee_idx_to_id[w]
-                # 総労働時間を加算
-                hours_per_employee[emp_id] += 1
-                # 総獲得難易度スコアを加算
-                difficulty_per_employee[emp_id] += difficulty_score_map.get((f, d, h), 0)
-
-        # 総勤務日数の計算 (これは works_on_day を使うので変更なし)
-        days_per_employee = {}
-        for w_idx in W_indices:
-            emp_id = employee_idx_to_id[w_idx]
-            total_days = sum(solver.Value(works_on_day[w_idx, d_idx]) for d_idx in D_indices)
-            days_per_employee[emp_id] = total_days
+        # 各従業員の総労働時間・総獲得難易度スコアも同じアサイン配列から集計する
+        hours_per_employee_arr = assigned.sum(axis=(0, 2, 3), dtype=np.int64)
+        difficulty_per_employee_arr = np.einsum('fwdh,fdh->w', assigned, difficulty_score_arr, dtype=np.int64) / SCALE_FACTOR
+        hours_per_employee = {employee_idx_to_id[w_idx]: int(hours_per_employee_arr[w_idx]) for w_idx in W_indices}
+        difficulty_per_employee = {employee_idx_to_id[w_idx]: float(difficulty_per_employee_arr[w_idx]) for w_idx in W_indices}
+
+        # 総勤務日数の計算 (works_on_day の解も変数ごとの solver.Value ではなく一括取得する)
+        works_on_day_values = get_boolean_values(solver, works_on_day_arr.ravel().tolist()).reshape(num_employees, num_total_days)
+        days_per_employee_arr = works_on_day_values.sum(axis=1)
+        days_per_employee = {employee_idx_to_id[w_idx]: int(days_per_employee_arr[w_idx]) for w_idx in W_indices}
 
         result["diagnostics"] = {
             "hours_worked_per_employee": hours_per_employee,
@@ -1071,14 +1282,145 @@ def solve_schedule(full_result_ref, schedule_input_data, cleaning_tasks_data, ti
         result['message'] = f"[{run_id}] 解が見つかりませんでした (ステータス: {status_str})"
         add_log(full_result_ref, 'errors', result['message'], {"status_code": status, "status_text": status_str})
 
-        if status == cp_model.INFEASIBLE and retry_attempt < MAX_RETRY_ATTEMPTS:
-            add_log(full_result_ref, 'warnings', f"[{run_id}] 実行不可能でした。ペナルティを緩和して再試行します (試行 {retry_attempt + 1}/{MAX_RETRY_ATTEMPTS})。")
-            new_penalty_multipliers = {k: v * PENALTY_REDUCTION_FACTOR for k, v in penalty_multipliers.items()}
-            return solve_schedule(schedule_input_data, cleaning_tasks_data, retry_attempt + 1, new_penalty_multipliers)
+        # 終了した理由をステータスごとに記録する
+        if status == cp_model.INFEASIBLE:
+            add_log(full_result_ref, 'errors', f"[{run_id}] ハード制約を同時に満たす解が存在しません。勤務可能時間や希望施設などの入力を見直してください。")
+        elif status == cp_model.MODEL_INVALID:
+            add_log(full_result_ref, 'errors', f"[{run_id}] モデルが不正です。", {"validation_error": model.Validate()})
         else:
-            if status == cp_model.INFEASIBLE:
-                add_log(full_result_ref, 'errors', f"[{run_id}] 最大試行回数 ({MAX_RETRY_ATTEMPTS}) に達しても実行不可能なままでした。")
-            return result # 最終的な失敗結果を返す
+            add_log(full_result_ref, 'errors', f"[{run_id}] 制限時間 ({time_limit_sec}秒) 内に実行可能解が見つかりませんでした。")
+        return result # 最終的な失敗結果を返す
+
+# ---------- GCS保存 ----------
+def upload_bytes_to_gcs(bucket, object_name, data, content_encoding=None, content_type=GCS_CONTENT_TYPE):
+    """
+    バイト列を GCS のオブジェクトとして保存する
+    GCS_COMPOSE_PART_SIZE 以上のデータはパートに分けてスレッドで並列アップロードし、compose で1つのオブジェクトに結合する
+    content_encoding は最終的なオブジェクトのメタデータに設定する (パートは単なるバイト列の断片として扱う)
+    """
+    if len(data) < GCS_COMPOSE_PART_SIZE:
+        blob = bucket.blob(object_name)
+        blob.content_encoding = content_encoding
+        blob.upload_from_file(io.BytesIO(data), size=len(data), content_type=content_type)
+        return
+
+    data_view = memoryview(data) # スライス自体はコピーしない (アップロード時に io.BytesIO がパート1つ分をコピーするため、同時に存在するコピーは最大 GCS_UPLOAD_MAX_WORKERS パート分)
+    part_offsets = range(0, len(data), GCS_COMPOSE_PART_SIZE)
+    part_blobs = [bucket.blob(f"{object_name}.{part_idx}.part") for part_idx in range(len(part_offsets))]
+    temporary_blobs = list(part_blobs)
+
+    def upload_part(part_blob, offset):
+        part_bytes = data_view[offset:offset + GCS_COMPOSE_PART_SIZE]
+        part_blob.upload_from_file(io.BytesIO(part_bytes), size=len(part_bytes), content_type=content_type)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=GCS_UPLOAD_MAX_WORKERS) as executor:
+            list(executor.map(upload_part, part_blobs, part_offsets)) # 例外があればここで送出される
+
+        # compose は1回あたり GCS_COMPOSE_MAX_SOURCES 個までなので、超える場合は段階的に結合する
+        compose_level = 0
+        while len(part_blobs) > GCS_COMPOSE_MAX_SOURCES:
+            composed_blobs = []
+            for group_start in range(0, len(part_blobs), GCS_COMPOSE_MAX_SOURCES):
+                composed_blob = bucket.blob(f"{object_name}.c{compose_level}_{group_start}.part")
+                composed_blob.compose(part_blobs[group_start:group_start + GCS_COMPOSE_MAX_SOURCES])
+                composed_blobs.append(composed_blob)
+                temporary_blobs.append(composed_blob)
+            part_blobs = composed_blobs
+            compose_level += 1
+
+        final_blob = bucket.blob(object_name)
+        final_blob.content_type = content_type
+        final_blob.content_encoding = content_encoding
+        final_blob.compose(part_blobs)
+    finally:
+        for temporary_blob in temporary_blobs:
+            try:
+                temporary_blob.delete()
+            except Exception as e: # 一時オブジェクトの削除失敗は結果の保存には影響しないため無視する
+                print(f"GCSの一時オブジェクト削除に失敗: {temporary_blob.name}: {e}", file=sys.stderr)
+
+
+# 結果とログのGCS保存は、このスレッドプールで並行して実行する
+gcs_upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=GCS_BACKGROUND_UPLOAD_WORKERS)
+
+@functools.lru_cache(maxsize=1)
+def get_gcs_bucket():
+    """
+    GCS_BUCKET_NAME のバケットハンドルを返す
+    クライアント生成 (認証情報の探索・接続プールの作成) はリクエストごとに行わず、初回呼び出し時に一度だけ行う
+    (インポート時に生成しないのは、認証情報のないローカル環境でもモジュールを読み込めるようにするため)
+    """
+    # 接続プールは storage.Client の既定 (ホストごとに10接続) を使う。パートの並列アップロード数 (GCS_UPLOAD_MAX_WORKERS) はこれ以下に収まる
+    storage_client = storage.Client()
+    return storage_client.bucket(GCS_BUCKET_NAME)
+
+def save_result_to_gcs(object_name, data, content_type=GCS_CONTENT_TYPE):
+    """
+    結果JSON (またはログのNDJSON) のバイト列を gzip 圧縮して GCS_BUCKET_NAME に保存する (バックグラウンドスレッドから呼ばれる)
+    Content-Encoding: gzip を付けるので、読み出し時は GCS 側で透過的に展開される
+    """
+    compressed_data = gzip.compress(data, compresslevel=GCS_GZIP_COMPRESS_LEVEL)
+    upload_bytes_to_gcs(get_gcs_bucket(), object_name, compressed_data, content_encoding='gzip', content_type=content_type)
+
+def wait_for_gcs_uploads(run_id, upload_futures, timeout):
+    """GCS保存の完了を最大 timeout 秒待ち、失敗またはタイムアウトした保存先とエラー内容の辞書を返す"""
+    done_futures, _ = concurrent.futures.wait(upload_futures.values(), timeout=timeout)
+    upload_errors = {}
+    for gcs_path, upload_future in upload_futures.items():
+        if upload_future not in done_futures:
+            upload_errors[gcs_path] = f"GCSへの保存が {timeout} 秒以内に完了しませんでした"
+        elif upload_future.exception() is not None:
+            upload_errors[gcs_path] = str(upload_future.exception())
+        else:
+            progress_logger.info("結果をGCSに保存しました: %s", gcs_path)
+            continue
+        print(f"[{run_id}] GCSへの結果保存中にエラー: {gcs_path}: {upload_errors[gcs_path]}", file=sys.stderr)
+    return upload_errors
+
+
+# 同じ入力の再送 (リトライやポーリング) でソルバーを動かし直さないよう、最適解をインスタンス内に保持する
+# 最適解 (OPTIMAL) 以外は制限時間やワーカー数で結果が変わりうるのでキャッシュしない
+solve_result_cache = collections.OrderedDict() # キャッシュキー -> (保存時刻, schedule_result, applied_constraints_history)
+solve_result_cache_lock = threading.Lock()
+
+def compute_solve_cache_key(schedule_input, cleaning_tasks_input):
+    """入力をキー順を揃えてシリアライズし、そのハッシュをキャッシュキーとして返す (クエリパラメータによる settings の変更を反映した後に呼ぶこと)"""
+    if orjson is not None:
+        canonical_bytes = orjson.dumps([schedule_input, cleaning_tasks_input], option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    else:
+        canonical_bytes = json.dumps([schedule_input, cleaning_tasks_input], sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.blake2b(canonical_bytes, digest_size=16).hexdigest()
+
+def get_cached_solve_result(cache_key):
+    """有効期間内のキャッシュがあれば (schedule_result, applied_constraints_history) のコピーを、なければ None を返す"""
+    with solve_result_cache_lock:
+        cached = solve_result_cache.get(cache_key)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[0] > SOLVE_CACHE_TTL_SEC:
+            del solve_result_cache[cache_key]
+            return None
+        solve_result_cache.move_to_end(cache_key)
+    # 呼び出し側が書き換えてもキャッシュや他のリクエストの結果に影響しないよう、コピーを返す (保存済みの値は変更されないのでロック外で行う)
+    return copy.deepcopy((cached[1], cached[2]))
+
+def put_cached_solve_result(cache_key, schedule_result, applied_constraints_history):
+    """最適解のコピーをキャッシュに保存する (上限を超えたら最も古く使われたものから捨てる)"""
+    schedule_result, applied_constraints_history = copy.deepcopy((schedule_result, applied_constraints_history))
+    with solve_result_cache_lock:
+        solve_result_cache[cache_key] = (time.monotonic(), schedule_result, applied_constraints_history)
+        solve_result_cache.move_to_end(cache_key)
+        while len(solve_result_cache) > SOLVE_CACHE_MAX_ENTRIES:
+            solve_result_cache.popitem(last=False)
+
+def rebind_cached_solve_result(schedule_result, applied_constraints_history, run_id):
+    """キャッシュから取り出した結果の run_id を、現在のリクエストの run_id に書き換える"""
+    schedule_result['run_id'] = run_id
+    for constraints_settings in [schedule_result.get('applied_constraints_settings'), *applied_constraints_history]:
+        if constraints_settings is not None:
+            constraints_settings['run_id'] = run_id
+
 
 # ---------- HTTPトリガー関数 ----------
 @functions_framework.http
@@ -1091,50 +1433,91 @@ def shift_optimazation(request):
     """
     # リクエストごとに結果を初期化
     current_full_result = {
-        'logs': {'schedule': [], 'overtime': [], 'errors': [], 'warnings': [], 'info': []},
+        'logs': create_empty_logs(),
         'schedule_result': None,
         'overtime_result': None,
         'applied_constraints_history': []
     }
+    request_start_time = time.monotonic()
     run_id_main = f"http_main_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S%f')}"
-    add_log(current_full_result, 'info', f"[{run_id_main}] HTTPリクエスト受信", {"headers": dict(request.headers)})
+    # GCSの保存先は run_id_main だけで決まるので最初に決めておく (アップロード完了を待たずにレスポンスへパスを含められる)
+    # オブジェクト名（ファイル名） (例: prefix + run_id + .json)
+    # run_id_main にはマイクロ秒まで含めているので、ほぼ一意になる
+    object_name = f"{GCS_OBJECT_PREFIX}{run_id_main}_solution.json"
+    gcs_path = f"gs://{GCS_BUCKET_NAME}/{object_name}"
+    current_full_result["gcs_output_path"] = gcs_path
+    if LOG_ENABLED: # ヘッダの抽出はログ無効時には不要
+        logged_headers = {name: request.headers[name] for name in LOG_REQUEST_HEADERS if name in request.headers}
+        add_log(current_full_result, 'info', f"[{run_id_main}] HTTPリクエスト受信", {"headers": logged_headers})
     
-    request_json = request.get_json(silent=True)
-    # Content-Typeの確認
+    # 大きすぎるボディは JSON の解析 (メモリ・CPU) を行う前に拒否する
+    # Content-Length があれば読み込む前に拒否し、ない場合 (chunked 転送) も上限+1バイトまでしか読まずに判定する
+    declared_too_large = request.content_length is not None and request.content_length > MAX_REQUEST_BODY_BYTES
+    request_body = b"" if declared_too_large else request.stream.read(MAX_REQUEST_BODY_BYTES + 1)
+    if declared_too_large or len(request_body) > MAX_REQUEST_BODY_BYTES:
+        msg = f"リクエストボディが大きすぎます (上限 {MAX_REQUEST_BODY_BYTES} バイト)。"
+        add_log(current_full_result, 'errors', f"[{run_id_main}] {msg}")
+        return (dumps_json_bytes({"error": msg, "logs": format_logs(current_full_result['logs'])}), 
+                413, JSON_RESPONSE_HEADERS)
+
+    # ボディは Flask の get_json (標準の json) を通さず、バイト列のまま loads_json (orjson) で読み込む
+    try:
+        request_json = loads_json(request_body)
+    except (ValueError, UnicodeDecodeError): # orjson.JSONDecodeError も ValueError のサブクラス
+        request_json = None
     if not request_json:
         msg = "リクエストボディが空か、JSON形式ではありません。"
         add_log(current_full_result, 'errors', f"[{run_id_main}] {msg}")
         # ensure_ascii=False をレスポンスヘッダと dumps の両方に適用
-        return (json.dumps({"error": msg, "logs": current_full_result['logs']}, ensure_ascii=False), 
-                400, {'Content-Type': 'application/json; charset=utf-8'})
-
-    schedule_input = request_json.get("schedule_input")
-    cleaning_tasks_input = request_json.get("cleaning_tasks_input")
+        return (dumps_json_bytes({"error": msg, "logs": format_logs(current_full_result['logs'])}), 
+                400, JSON_RESPONSE_HEADERS)
 
-    if not schedule_input or not cleaning_tasks_input:
-        msg = "リクエストJSONに必要なキー 'schedule_input' または 'cleaning_tasks_input' がありません。"
+    msg = get_combined_input_error(request_json)
+    if msg is not None:
         add_log(current_full_result, 'errors', f"[{run_id_main}] {msg}")
-        return (json.dumps({"error": msg, "logs": current_full_result['logs']}, ensure_ascii=False), 
-                400, {'Content-Type': 'application/json; charset=utf-8'})
-
-    time_limit_schedule_sec = request.args.get('time_limit_sec', str(DEFAULT_TIME_LIMIT_SEC)) # strで取得
-    try:
-        time_limit_schedule_sec = int(time_limit_schedule_sec)
-        if time_limit_schedule_sec <= 0: time_limit_schedule_sec = DEFAULT_TIME_LIMIT_SEC
-    except ValueError:
-        add_log(current_full_result, 'warnings', f"[{run_id_main}] time_limit_sec の値が無効です ({request.args.get('time_limit_sec')})。デフォルト値 {DEFAULT_TIME_LIMIT_SEC} を使用します。")
+        return (dumps_json_bytes({"error": msg, "logs": format_logs(current_full_result['logs'])}), 
+                400, JSON_RESPONSE_HEADERS)
+
+    schedule_input = request_json["schedule_input"]
+    cleaning_tasks_input = request_json["cleaning_tasks_input"]
+    schedule_settings = schedule_input.get('settings', {}) # 以降の参照のため一度だけ取り出しておく
+
+    # クエリパラメータがなければ入力の settings.time_limit_sec、それもなければデフォルト値を使う (30.0 や 0.5 などの実数も受け付ける)
+    raw_time_limit_sec = request.args.get('time_limit_sec')
+    if raw_time_limit_sec is None:
+        raw_time_limit_sec = schedule_settings.get('time_limit_sec', DEFAULT_TIME_LIMIT_SEC)
+    time_limit_schedule_sec = get_valid_time_limit_sec(raw_time_limit_sec)
+    if time_limit_schedule_sec is None:
+        add_log(current_full_result, 'warnings', f"[{run_id_main}] time_limit_sec の値が無効です ({raw_time_limit_sec})。デフォルト値 {DEFAULT_TIME_LIMIT_SEC} を使用します。")
         time_limit_schedule_sec = DEFAULT_TIME_LIMIT_SEC
+    # プラットフォームのタイムアウトで強制終了されると結果を返せないため、残り時間から結果保存分を引いた値を上限にする
+    # (制限時間に達した場合でも、それまでに見つかった最良解が返る)
+    remaining_request_sec = REQUEST_TIMEOUT_SEC - (time.monotonic() - request_start_time) - RESERVED_POST_SOLVE_SEC
+    time_limit_schedule_sec = min(time_limit_schedule_sec, max(1, int(remaining_request_sec)))
     add_log(current_full_result, 'info', f"[{run_id_main}] スケジュールソルバーの制限時間: {time_limit_schedule_sec}秒")
-
-
-    if 'settings' in schedule_input and 'facilities' in schedule_input and 'employees' in schedule_input:
-        print(f"--- [{run_id_main}] シフトスケジューリングを開始 ---", file=sys.stderr)
-        current_full_result['schedule_result'] = solve_schedule(current_full_result, schedule_input, cleaning_tasks_input, time_limit_schedule_sec, 0, None)
-        print(f"--- [{run_id_main}] シフトスケジューリングを終了 ---", file=sys.stderr)
+    # 並列探索のワーカー数はクエリパラメータでも指定できる (インスタンスのCPU数に合わせて呼び出し側が調整できるように)
+    # (str.isdigit は "²" のような int() で変換できない文字も真になるため、isdecimal で判定する)
+    raw_num_workers = request.args.get('num_workers')
+    if raw_num_workers is not None:
+        if not raw_num_workers.isdecimal() or int(raw_num_workers) <= 0:
+            msg = f"num_workers は1以上の整数で指定してください ({raw_num_workers})。"
+            add_log(current_full_result, 'errors', f"[{run_id_main}] {msg}")
+            return (dumps_json_bytes({"error": msg, "logs": format_logs(current_full_result['logs'])}),
+                    400, JSON_RESPONSE_HEADERS)
+        schedule_settings['num_workers'] = min(int(raw_num_workers), os.cpu_count() or 1) # CPU 数を超える指定は頭打ちにする
+
+    solve_cache_key = compute_solve_cache_key(schedule_input, cleaning_tasks_input) # settings への変更をすべて反映した後に計算する
+    cached_solve_result = get_cached_solve_result(solve_cache_key)
+    if cached_solve_result is not None:
+        add_log(current_full_result, 'info', f"[{run_id_main}] 同一入力の最適解がキャッシュにあるため、ソルバーの実行を省略します")
+        current_full_result['schedule_result'], current_full_result['applied_constraints_history'] = cached_solve_result
+        rebind_cached_solve_result(current_full_result['schedule_result'], current_full_result['applied_constraints_history'], f"cached_{run_id_main}")
     else:
-        msg = 'スケジューリングに必要な基本データ（settings, facilities, employees）が不足しています。'
-        add_log(current_full_result, 'errors', f"[{run_id_main}] {msg}")
-        current_full_result['schedule_result'] = {'status': 'NO_DATA_ERROR', 'message': msg, 'run_id': run_id_main}
+        progress_logger.info("--- [%s] シフトスケジューリングを開始 ---", run_id_main)
+        current_full_result['schedule_result'] = solve_schedule(current_full_result, schedule_input, cleaning_tasks_input, time_limit_schedule_sec)
+        progress_logger.info("--- [%s] シフトスケジューリングを終了 ---", run_id_main)
+        if (current_full_result['schedule_result'] or {}).get('status') == 'OPTIMAL':
+            put_cached_solve_result(solve_cache_key, current_full_result['schedule_result'], current_full_result['applied_constraints_history'])
 
     # if 'overtime_lp' in schedule_input:
     #     print(f"--- [{run_id_main}] 残業時間最適配分を開始 ---", file=sys.stderr)
@@ -1145,112 +1528,134 @@ def shift_optimazation(request):
     #     current_full_result['overtime_result'] = {'status': 'NOT_REQUESTED', 'message': '残業データが入力ファイルにありませんでした。', 'run_id': run_id_main}
 
     # --- GCSへの保存処理 ---
-    try:
-        result_json_string = json.dumps(current_full_result, indent=2, ensure_ascii=False)
-        
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(GCS_BUCKET_NAME)
-        
-        # オブジェクト名（ファイル名） (例: prefix + run_id + .json)
-        # run_id_main にはマイクロ秒まで含めているので、ほぼ一意になる
-        object_name = f"{GCS_OBJECT_PREFIX}{run_id_main}_solution.json"
-        
-        blob = bucket.blob(object_name)
-        blob.upload_from_string(
-            result_json_string,
-            content_type='application/json'
-        )
-        gcs_path = f"gs://{GCS_BUCKET_NAME}/{object_name}"
-        add_log(current_full_result, 'info', f"[{run_id_main}] 結果JSONをGCSに保存成功: {gcs_path}")
-        print(f"結果をGCSに保存しました: {gcs_path}", file=sys.stderr)
-        current_full_result["gcs_output_path"] = gcs_path # レスポンスにもパスを含める
-
-    except Exception as e:
-        error_message_gcs = f"[{run_id_main}] GCSへの結果保存中にエラー: {str(e)}"
-        add_log(current_full_result, 'errors', error_message_gcs)
-        print(error_message_gcs, file=sys.stderr)
-        # エラーが発生しても、HTTPレスポンスは返す
-        current_full_result["gcs_save_error"] = str(e)
-
+    # 結果は一度だけ UTF-8 のバイト列にシリアライズし、GCSへのアップロードとHTTPレスポンスの両方で使い回す
     add_log(current_full_result, 'info', f"[{run_id_main}] HTTPリクエスト処理終了")
-    return (json.dumps(current_full_result, indent=2, ensure_ascii=False), 
-            200, {'Content-Type': 'application/json; charset=utf-8'})
+    # 全ログは別オブジェクトに NDJSON で保存し、結果JSONには errors と warnings だけを残す (他のカテゴリは保存先と件数のみ)
+    logs = current_full_result['logs']
+    current_full_result['logs'] = get_inline_logs(logs)
+    current_full_result['log_counts'] = count_logs(logs)
+    current_full_result['log_gcs_path'] = None
+    upload_futures = {}
+    # ログの別オブジェクトへの保存は、ログを明示的に有効化した場合 (SOLVE_LOG_ENABLED=1) だけ行う
+    if LOG_ENABLED and any(current_full_result['log_counts'].values()):
+        log_object_name = f"{GCS_OBJECT_PREFIX}{run_id_main}_logs.ndjson"
+        current_full_result['log_gcs_path'] = f"gs://{GCS_BUCKET_NAME}/{log_object_name}"
+        upload_futures[current_full_result['log_gcs_path']] = gcs_upload_executor.submit(save_result_to_gcs, log_object_name, dumps_logs_ndjson_bytes(logs), GCS_LOG_CONTENT_TYPE)
+    result_json_bytes = dumps_json_bytes(current_full_result) # 機械が読むデータなのでインデントなしのコンパクト形式にする (整形はローカル実行の出力のみ)
+    upload_futures[gcs_path] = gcs_upload_executor.submit(save_result_to_gcs, object_name, result_json_bytes)
+
+    # 結果とログのアップロードは並行して行い、レスポンスを返す前に完了を待つ (リクエスト終了後はCPUが割り当てられない可能性があるため)
+    gcs_upload_errors = wait_for_gcs_uploads(run_id_main, upload_futures, GCS_UPLOAD_WAIT_TIMEOUT_SEC)
+    if gcs_upload_errors:
+        # 保存できなかったパスは返さず、エラー内容をレスポンスに含める (このときGCS上の結果にはエラーは記録されない)
+        current_full_result['gcs_save_error'] = "; ".join(f"{path}: {error}" for path, error in gcs_upload_errors.items())
+        if gcs_path in gcs_upload_errors:
+            current_full_result['gcs_output_path'] = None
+        if current_full_result['log_gcs_path'] in gcs_upload_errors:
+            current_full_result['log_gcs_path'] = None
+        result_json_bytes = dumps_json_bytes(current_full_result)
+
+    # ソルバーのステータスをHTTPステータスコードに反映する (本文の構造は変えない)
+    schedule_status = (current_full_result['schedule_result'] or {}).get('status')
+    http_status_code = SCHEDULE_STATUS_HTTP_CODE_MAP.get(schedule_status, 500)
+    response_headers = {'Content-Type': 'application/json; charset=utf-8', 'X-Solver-Status': str(schedule_status),
+                        'X-Solver-Cache': 'HIT' if cached_solve_result is not None else 'MISS'}
+
+    # ?response=summary の場合は、結果本体 (GCSに保存済み) を返さずに保存先とステータスだけを返す
+    if request.args.get('response') == 'summary':
+        response_summary = {
+            "run_id": run_id_main,
+            "gcs_output_path": current_full_result['gcs_output_path'],
+            "status": schedule_status,
+            "log_gcs_path": current_full_result['log_gcs_path'],
+            "log_counts": current_full_result['log_counts'],
+            "logs": current_full_result['logs']
+        }
+        if 'gcs_save_error' in current_full_result:
+            response_summary['gcs_save_error'] = current_full_result['gcs_save_error']
+        return (dumps_json_bytes(response_summary), http_status_code, response_headers)
+
+    # 人が確認する場合 (?pretty=1) だけインデント付きで返す (GCSに保存するのはコンパクト形式のまま)
+    if request.args.get('pretty'):
+        return (dumps_json_bytes(current_full_result, indent=True), http_status_code, response_headers)
+    return (result_json_bytes, http_status_code, response_headers)
 
 
 # コマンドライン実行用の main 関数 (ローカルテスト用)
 def local_main():
-    global _local_full_result_for_testing_only # ローカルテスト専用のグローバル変数を使用
-    run_id_main = f"local_main_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    # ローカル実行では進捗を見たいので、SOLVE_LOG_LEVEL の指定がなければ INFO で出力する
+    if 'SOLVE_LOG_LEVEL' not in os.environ:
+        progress_logger.setLevel(logging.INFO)
+    # 開始時刻の整形は1回だけにし、同じ秒に起動した実行とも区別できるよう time_ns の下位ビットを付ける
+    run_id_main = f"local_main_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{time.time_ns() & 0xffff:04x}"
     
-    # _local_full_result_for_testing_only の 'logs' と 'applied_constraints_history' を初期化
-    _local_full_result_for_testing_only['logs'] = {
-        'schedule': [], 'overtime': [], 'errors': [], 'warnings': [], 'info': []
+    # 実行ごとに結果を初期化 (HTTP関数と同じく呼び出しごとのローカルな辞書を使い、実行間で状態を共有しない)
+    local_full_result = {
+        'logs': create_empty_logs(),
+        'schedule_result': None,
+        'overtime_result': None,
+        'applied_constraints_history': []
     }
-    _local_full_result_for_testing_only['applied_constraints_history'] = []
 
-    # add_log は _local_full_result_for_testing_only['logs'] に記録する想定
-    add_log(_local_full_result_for_testing_only, 'info', f"[{run_id_main}] ローカル実行開始", {"arguments": sys.argv})
+    # add_log は local_full_result['logs'] に記録する想定
+    add_log(local_full_result, 'info', f"[{run_id_main}] ローカル実行開始", {"arguments": sys.argv})
+
+    def exit_with_error(error_msg):
+        """エラーをログに記録し、標準エラーに出力して終了する (標準出力には何も出さない)"""
+        add_log(local_full_result, 'errors', f"[{run_id_main}] {error_msg}")
+        print(error_msg, file=sys.stderr)
+        sys.exit(1)
 
     if len(sys.argv) < 2:
-        msg = '使用方法: python solve_new.py <combined_input_data.json>'
-        add_log(_local_full_result_for_testing_only, 'errors', f"[{run_id_main}] {msg}")
-        print(msg, file=sys.stderr) # ★標準エラーに出力
-        # print(json.dumps(_local_full_result_for_testing_only, indent=2, ensure_ascii=False)) # ★この行を削除またはコメントアウト
-        sys.exit(1) # エラーメッセージ出力後、終了
+        exit_with_error('使用方法: python solve_new.py <combined_input_data.json>')
     
     combined_input_filepath = sys.argv[1]
 
     try:
-        with open(combined_input_filepath, 'r', encoding='utf-8') as f: combined_input_data = json.load(f)
-        add_log(_local_full_result_for_testing_only, 'info', f"[{run_id_main}] 結合入力ファイル '{combined_input_filepath}' の読み込み成功")
+        with open(combined_input_filepath, 'rb') as f: combined_input_data = loads_json(f.read())
     except FileNotFoundError:
-        error_msg = f"結合入力ファイル '{combined_input_filepath}' が見つかりません。"
-        add_log(_local_full_result_for_testing_only, 'errors', f"[{run_id_main}] {error_msg}")
-        print(error_msg, file=sys.stderr) # ★標準エラー
-        # print(json.dumps(_local_full_result_for_testing_only, indent=2, ensure_ascii=False)); # ★削除
-        sys.exit(1)
-    except json.JSONDecodeError as e:
-        error_msg = f"結合入力ファイル '{combined_input_filepath}' のJSON形式エラー: {e}"
-        add_log(_local_full_result_for_testing_only, 'errors', f"[{run_id_main}] {error_msg}")
-        print(error_msg, file=sys.stderr) # ★標準エラー
-        # print(json.dumps(_local_full_result_for_testing_only, indent=2, ensure_ascii=False)); # ★削除
-        sys.exit(1)
-
-    schedule_input = combined_input_data.get("schedule_input")
-    cleaning_tasks_input = combined_input_data.get("cleaning_tasks_input")
-
-    if not schedule_input or not cleaning_tasks_input:
-        msg = "結合入力JSONに必要なキー 'schedule_input' または 'cleaning_tasks_input' がありません。"
-        add_log(_local_full_result_for_testing_only, 'errors', f"[{run_id_main}] {msg}")
-        print(msg, file=sys.stderr) # ★標準エラー
-        # print(json.dumps(_local_full_result_for_testing_only, indent=2, ensure_ascii=False)); # ★削除
-        sys.exit(1)
-
-    time_limit_schedule_sec = schedule_input.get("settings", {}).get("time_limit_sec", DEFAULT_TIME_LIMIT_SEC)
-    add_log(_local_full_result_for_testing_only, 'info', f"[{run_id_main}] スケジュールソルバーの制限時間(ローカル): {time_limit_schedule_sec}秒")
+        exit_with_error(f"結合入力ファイル '{combined_input_filepath}' が見つかりません。")
+    except (ValueError, UnicodeDecodeError) as e:
+        exit_with_error(f"結合入力ファイル '{combined_input_filepath}' のJSON形式エラー: {e}")
+    add_log(local_full_result, 'info', f"[{run_id_main}] 結合入力ファイル '{combined_input_filepath}' の読み込み成功")
+
+    msg = get_combined_input_error(combined_input_data)
+    if msg is not None:
+        exit_with_error(msg)
+
+    schedule_input = combined_input_data["schedule_input"]
+    cleaning_tasks_input = combined_input_data["cleaning_tasks_input"]
+    schedule_settings = schedule_input.get("settings", {})
+
+    raw_time_limit_sec = schedule_settings.get("time_limit_sec", DEFAULT_TIME_LIMIT_SEC)
+    time_limit_schedule_sec = get_valid_time_limit_sec(raw_time_limit_sec)
+    if time_limit_schedule_sec is None:
+        add_log(local_full_result, 'warnings', f"[{run_id_main}] settings.time_limit_sec の値が無効です ({raw_time_limit_sec})。デフォルト値 {DEFAULT_TIME_LIMIT_SEC} を使用します。")
+        time_limit_schedule_sec = DEFAULT_TIME_LIMIT_SEC
+    add_log(local_full_result, 'info', f"[{run_id_main}] スケジュールソルバーの制限時間(ローカル): {time_limit_schedule_sec}秒")
 
-    # 以下の print 文は既に file=sys.stderr になっているので問題なし
-    if 'settings' in schedule_input and 'facilities' in schedule_input and 'employees' in schedule_input:
-        print(f"--- [{run_id_main}] シフトスケジューリングを開始 ---", file=sys.stderr)
-        _local_full_result_for_testing_only['schedule_result'] = solve_schedule(_local_full_result_for_testing_only, schedule_input, cleaning_tasks_input, time_limit_schedule_sec, 0, None)
-        print(f"--- [{run_id_main}] シフトスケジューリングを終了 ---", file=sys.stderr)
-    else:
-        msg = 'スケジューリングに必要な基本データ（settings, facilities, employees）が不足しています。'
-        add_log(_local_full_result_for_testing_only, 'errors', f"[{run_id_main}] {msg}")
-        _local_full_result_for_testing_only['schedule_result'] = {'status': 'NO_DATA_ERROR', 'message': msg, 'run_id': run_id_main}
+    progress_logger.info("--- [%s] シフトスケジューリングを開始 ---", run_id_main)
+    local_full_result['schedule_result'] = solve_schedule(local_full_result, schedule_input, cleaning_tasks_input, time_limit_schedule_sec)
+    progress_logger.info("--- [%s] シフトスケジューリングを終了 ---", run_id_main)
 
     # if 'overtime_lp' in schedule_input:
     #     print(f"--- [{run_id_main}] 残業時間最適配分を開始 ---", file=sys.stderr)
-    #     _local_full_result_for_testing_only['overtime_result'] = solve_overtime_lp(_local_full_result_for_testing_only, schedule_input.get('overtime_lp', {}))
+    #     local_full_result['overtime_result'] = solve_overtime_lp(local_full_result, schedule_input.get('overtime_lp', {}))
     #     print(f"--- [{run_id_main}] 残業時間最適配分を終了 ---", file=sys.stderr)
     # else:
-    #     add_log(_local_full_result_for_testing_only, 'info', f"[{run_id_main}] 入力データに overtime_lp セクションが存在しないため、残業配分処理をスキップします。")
-    #     _local_full_result_for_testing_only['overtime_result'] = {'status': 'NOT_REQUESTED', 'message': '残業データが入力ファイルにありませんでした。', 'run_id': run_id_main}
+    #     add_log(local_full_result, 'info', f"[{run_id_main}] 入力データに overtime_lp セクションが存在しないため、残業配分処理をスキップします。")
+    #     local_full_result['overtime_result'] = {'status': 'NOT_REQUESTED', 'message': '残業データが入力ファイルにありませんでした。', 'run_id': run_id_main}
 
-    add_log(_local_full_result_for_testing_only, 'info', f"[{run_id_main}] ローカル実行終了")
+    add_log(local_full_result, 'info', f"[{run_id_main}] ローカル実行終了")
     
     # ★ 最終的なJSON結果のみを標準出力に出力
-    print(json.dumps(_local_full_result_for_testing_only, indent=2, ensure_ascii=False))
+    # 全ログは NDJSON で標準エラーに出力し、標準出力の結果JSONには errors と warnings と件数だけを残す
+    logs = local_full_result['logs']
+    local_full_result['logs'] = get_inline_logs(logs)
+    sys.stderr.write(dumps_logs_ndjson_bytes(logs).decode('utf-8'))
+    local_full_result['log_counts'] = count_logs(logs)
+    # 人が読むための出力なのでインデントは残し、シリアライズは dumps_json_bytes (orjson) でバイト列のまま書き出す
+    sys.stdout.buffer.write(dumps_json_bytes(local_full_result, indent=True) + b"\n")
 
 if __name__ == '__main__':
     local_main()
@@ -0,0 +1,45 @@
+import importlib.util
+import os
+
+import pytest
+
+# legacy/ はパッケージではないので、ファイルを直接読み込む
+_spec = importlib.util.spec_from_file_location("legacy_solve", os.path.join(os.path.dirname(__file__), "legacy", "solve.py"))
+legacy_solve = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(legacy_solve)
+
+OVERTIME_CASES = [
+    {"employees": [{"id": "a", "max_overtime": 10, "overtime_cost": 3},
+                   {"id": "b", "max_overtime": 5, "overtime_cost": 1},
+                   {"id": "c", "max_overtime": 8, "overtime_cost": 2}],
+     "total_overtime_hours": 12},
+    {"employees": [{"id": "a", "max_overtime": 4, "overtime_cost": 2.5},
+                   {"id": "b", "max_overtime": 0, "overtime_cost": 1},
+                   {"id": "c", "max_overtime": 6},
+                   {"id": "d", "max_overtime": 3, "overtime_cost": 2.5}],
+     "total_overtime_hours": 9.5},
+]
+
+
+@pytest.mark.parametrize("overtime_input", OVERTIME_CASES)
+def test_greedy_matches_lp_objective(overtime_input):
+    """貪欲法 (既定) と HiGHS の LP で目的関数値が一致する"""
+    lp_result = legacy_solve.solve_overtime_lp({**overtime_input, "use_lp_solver": True})
+    if lp_result["status"] != "OK":
+        pytest.skip(f"HiGHS で解けない環境です ({lp_result['status']})")
+    greedy_result = legacy_solve.solve_overtime_lp(overtime_input)
+    assert greedy_result["status"] == "OK"
+    assert greedy_result["objective"] == pytest.approx(lp_result["objective"])
+    assert sum(a["overtime_hours"] for a in greedy_result["allocation"]) == pytest.approx(overtime_input["total_overtime_hours"])
+
+
+def test_greedy_allocates_cheapest_first():
+    greedy_result = legacy_solve.solve_overtime_lp(OVERTIME_CASES[0])
+    assert greedy_result["status"] == "OK"
+    assert greedy_result["objective"] == 19 # b: 5h x 1 + c: 7h x 2
+    assert {a["id"]: a["overtime_hours"] for a in greedy_result["allocation"]} == {"a": 0, "b": 5, "c": 7}
+
+
+def test_greedy_reports_infeasible_when_capacity_is_short():
+    greedy_result = legacy_solve.solve_overtime_lp({**OVERTIME_CASES[0], "total_overtime_hours": 30})
+    assert greedy_result["status"] == "INFEASIBLE"
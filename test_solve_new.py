@@ -0,0 +1,189 @@
+import collections
+
+import flask
+import numpy as np
+import pytest
+
+import solve_new
+
+
+def make_combined_input(num_workers=None):
+    """ハンドラーのテスト用の最小の入力 (スキーマ検証を通る構造のみ)"""
+    settings = {"planning_start_date": "2024-01-01", "num_days_in_planning_period": 1}
+    if num_workers is not None:
+        settings["num_workers"] = num_workers
+    return {
+        "schedule_input": {
+            "settings": settings,
+            "facilities": [{"id": "F1"}],
+            "employees": [{"id": "E1", "availability": []}]
+        },
+        "cleaning_tasks_input": {"F1": {"default_tasks_for_day_of_week": {"Mon": 6}}}
+    }
+
+
+def test_build_greedy_hint_fills_required_staff():
+    """必要人数のある施設に割り当て、同じ従業員の重複する時間帯のスロットは割り当てない"""
+    required_staff_arr = np.zeros((2, 1, 24), dtype=np.int32)
+    required_staff_arr[1, 0, 9:12] = 1 # 施設1 の 9-12時だけ1名必要
+    slots_covered_hours = [
+        [(0, 9), (0, 10), (0, 11)],
+        [(0, 10), (0, 11)], # スロット0 と同じ従業員で時間が重なる
+        [(0, 9), (0, 10), (0, 11)] # 別の従業員だが必要人数は充足済み
+    ]
+    slot_assignment = solve_new.build_greedy_hint(
+        slots_covered_hours, [0, 0, 1], [[0, 1], [0, 1], [0, 1]], required_staff_arr,
+        num_employees=2, max_weekly_hours=40, min_rest_hours=8
+    )
+    assert slot_assignment == {0: 1}
+
+
+def test_build_greedy_hint_respects_weekly_hours_and_rest():
+    """週の最大労働時間と勤務間インターバルを超える割り当ては行わない"""
+    required_staff_arr = np.ones((1, 2, 24), dtype=np.int32)
+    slot_assignment = solve_new.build_greedy_hint(
+        [[(0, h) for h in range(8)], [(0, h) for h in range(10, 14)], [(1, h) for h in range(10, 14)]],
+        [0, 0, 0], [[0], [0], [0]], required_staff_arr,
+        num_employees=1, max_weekly_hours=10, min_rest_hours=8
+    )
+    # スロット1 はインターバル不足、スロット2 は週の上限 (8+4 > 10) を超える
+    assert slot_assignment == {0: 0}
+
+
+def test_prepare_shortage_penalties_without_difficulty():
+    """清掃時間帯は清掃タスク数から必要人数を計算し、ペナルティは施設のベースペナルティ×スケールになる"""
+    difficulty_score_arr = np.full((2, 1, 24), 1000.0)
+    cleaning_tasks_arr = np.array([[6.0], [0.0]])
+    required_staff_arr, shortage_penalty_arr = solve_new.prepare_shortage_penalties(
+        difficulty_score_arr, cleaning_tasks_arr, np.array([1.0, 1.0]), np.array([5.0, 7.0]),
+        10, 13, 2.0, False, 1000
+    )
+    assert required_staff_arr.dtype == np.int32
+    assert shortage_penalty_arr.dtype == np.int64
+    assert required_staff_arr[0, 0, 10:13].tolist() == [2, 2, 2] # ceil(6 / (1 * 3))
+    assert required_staff_arr[1, 0, 10:13].tolist() == [1, 1, 1] # タスクが0でも最低1名
+    assert required_staff_arr[:, :, :10].max() == 1 and required_staff_arr[:, :, 13:].max() == 1
+    assert (shortage_penalty_arr[0] == 5000).all() and (shortage_penalty_arr[1] == 7000).all()
+
+
+def test_prepare_shortage_penalties_with_difficulty():
+    """難易度を適用する場合はベースペナルティ×難易度スコア (スケール済み) を整数に丸める"""
+    difficulty_score_arr = np.full((1, 1, 24), 1500.4)
+    _, shortage_penalty_arr = solve_new.prepare_shortage_penalties(
+        difficulty_score_arr, np.zeros((1, 1)), np.array([1.0]), np.array([2.0]),
+        10, 13, 2.0, True, 1000
+    )
+    assert (shortage_penalty_arr == 3001).all()
+
+
+@pytest.mark.parametrize("schedule_status, expected_http_code", [
+    ('OPTIMAL', 200), ('FEASIBLE', 200), ('UNKNOWN', 504), ('INFEASIBLE', 422), ('MODEL_INVALID', 500), ('SOMETHING_ELSE', 500)
+])
+def test_handler_maps_schedule_status_to_http_code(monkeypatch, schedule_status, expected_http_code):
+    """ソルバーの結果ステータスがHTTPステータスコードとヘッダに反映される"""
+    monkeypatch.setattr(solve_new, 'solve_result_cache', collections.OrderedDict())
+    monkeypatch.setattr(solve_new, 'save_result_to_gcs', lambda *args: None)
+    monkeypatch.setattr(solve_new, 'solve_schedule', lambda *args: {'status': schedule_status, 'run_id': 'attempt_0_test'})
+    with flask.Flask(__name__).test_request_context('/?response=summary', method='POST', json=make_combined_input()):
+        body, http_code, headers = solve_new.shift_optimazation(flask.request)
+    assert http_code == expected_http_code
+    assert headers['X-Solver-Status'] == schedule_status
+    assert solve_new.loads_json(body)['status'] == schedule_status
+
+
+def test_every_solver_status_has_http_code():
+    for status_str in solve_new.CP_SOLVER_STATUS_MAP.values():
+        assert status_str in solve_new.SCHEDULE_STATUS_HTTP_CODE_MAP
+
+
+def test_solve_cache_key_is_stable():
+    """キャッシュキーは辞書のキー順に依存せず、入力や settings が変われば変わる"""
+    combined_input = make_combined_input()
+    reordered_settings = dict(reversed(list(combined_input["schedule_input"]["settings"].items())))
+    reordered_schedule_input = {**combined_input["schedule_input"], "settings": reordered_settings}
+    key = solve_new.compute_solve_cache_key(combined_input["schedule_input"], combined_input["cleaning_tasks_input"])
+    assert key == solve_new.compute_solve_cache_key(reordered_schedule_input, combined_input["cleaning_tasks_input"])
+    assert key == solve_new.compute_solve_cache_key(make_combined_input()["schedule_input"], make_combined_input()["cleaning_tasks_input"])
+
+    other_input = make_combined_input(num_workers=2)
+    assert key != solve_new.compute_solve_cache_key(other_input["schedule_input"], other_input["cleaning_tasks_input"])
+    assert key != solve_new.compute_solve_cache_key(combined_input["schedule_input"], {"F1": {"default_tasks_for_day_of_week": {"Mon": 7}}})
+
+
+def test_cached_result_is_isolated_per_request(monkeypatch):
+    """キャッシュから取り出した結果を書き換えても、キャッシュ内の値は変わらない"""
+    monkeypatch.setattr(solve_new, 'solve_result_cache', collections.OrderedDict())
+    schedule_result = {'status': 'OPTIMAL', 'run_id': 'attempt_0_a', 'assignments': []}
+    solve_new.put_cached_solve_result('key', schedule_result, [{'run_id': 'attempt_0_a'}])
+    schedule_result['assignments'].append('modified after put')
+
+    cached_result, cached_history = solve_new.get_cached_solve_result('key')
+    solve_new.rebind_cached_solve_result(cached_result, cached_history, 'cached_b')
+    assert cached_result == {'status': 'OPTIMAL', 'run_id': 'cached_b', 'assignments': []}
+    assert cached_history == [{'run_id': 'cached_b'}]
+    assert solve_new.get_cached_solve_result('key')[0]['run_id'] == 'attempt_0_a'
+
+
+@pytest.mark.parametrize("settings_override, query", [
+    ({"random_seed": "abc"}, ""), ({"random_seed": 1.5}, ""), ({"num_workers": 0}, ""), ({"num_workers": True}, ""),
+    ({"core_minimization_level": "x"}, ""), ({"core_minimization_level": 3}, ""), ({"linearization_level": -1}, ""),
+    ({}, "num_workers=abc"), ({}, "num_workers=0")
+])
+def test_handler_rejects_invalid_solver_settings(monkeypatch, settings_override, query):
+    """ソルバーに渡す settings やクエリパラメータが不正な場合は、ソルバーを実行せずに 400 を返す"""
+    monkeypatch.setattr(solve_new, 'solve_schedule', lambda *args: pytest.fail("solve_schedule should not be called"))
+    combined_input = make_combined_input()
+    combined_input["schedule_input"]["settings"].update(settings_override)
+    with flask.Flask(__name__).test_request_context(f'/?{query}', method='POST', json=combined_input):
+        body, http_code, _ = solve_new.shift_optimazation(flask.request)
+    assert http_code == 400
+    assert 'error' in solve_new.loads_json(body)
+
+
+def test_num_workers_is_capped_by_cpu_count(monkeypatch):
+    """num_workers に CPU 数を超える値を指定しても、CPU 数で頭打ちにする"""
+    monkeypatch.setattr(solve_new.os, 'cpu_count', lambda: 2)
+    combined_input = make_combined_input(num_workers=5000)
+    solved_settings = {}
+    monkeypatch.setattr(solve_new, 'solve_result_cache', collections.OrderedDict())
+    monkeypatch.setattr(solve_new, 'save_result_to_gcs', lambda *args: None)
+    monkeypatch.setattr(solve_new, 'solve_schedule', lambda full_result, schedule_input, *args: solved_settings.update(schedule_input["settings"]) or {'status': 'OPTIMAL'})
+    with flask.Flask(__name__).test_request_context('/?num_workers=64', method='POST', json=combined_input):
+        solve_new.shift_optimazation(flask.request)
+    assert solved_settings["num_workers"] == 2
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_handler_rejects_too_large_body(monkeypatch, chunked):
+    """Content-Length の有無 (chunked 転送) にかかわらず、上限を超えるボディは 413 で拒否する"""
+    monkeypatch.setattr(solve_new, 'MAX_REQUEST_BODY_BYTES', 16)
+    monkeypatch.setattr(solve_new, 'solve_schedule', lambda *args: pytest.fail("solve_schedule should not be called"))
+    body = solve_new.dumps_json_bytes(make_combined_input())
+    environ_overrides = {'wsgi.input_terminated': True} if chunked else {}
+    with flask.Flask(__name__).test_request_context('/', method='POST', data=body, content_type='application/json', environ_overrides=environ_overrides) as request_context:
+        if chunked:
+            request_context.request.environ.pop('CONTENT_LENGTH', None)
+            assert flask.request.content_length is None
+        _, http_code, _ = solve_new.shift_optimazation(flask.request)
+    assert http_code == 413
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize("body", [b'{"schedule_input": "\xff"}', b'{not json', b''])
+def test_handler_rejects_malformed_body(monkeypatch, use_orjson, body):
+    """不正な JSON や UTF-8 として不正なボディは、orjson の有無にかかわらず 400 を返す"""
+    if not use_orjson:
+        monkeypatch.setattr(solve_new, 'orjson', None)
+    with flask.Flask(__name__).test_request_context('/', method='POST', data=body, content_type='application/json'):
+        _, http_code, _ = solve_new.shift_optimazation(flask.request)
+    assert http_code == 400
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("30", 30.0), ("0.5", 0.5), ("30.", 30.0), (".5", 0.5), (45, 45), (2.5, 2.5),
+    ("0", None), ("-1", None), ("abc", None), ("1e3", None), ("nan", None), ("inf", None), ("９", None), ("", None), ("9" * 400, None),
+    (0, None), (-3, None), (True, None), (float('inf'), None), (None, None)
+])
+def test_get_valid_time_limit_sec(value, expected):
+    """正の有限な実数 (数値表記の文字列を含む) のみを受け付け、それ以外は None を返す"""
+    assert solve_new.get_valid_time_limit_sec(value) == expected